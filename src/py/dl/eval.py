@@ -18,6 +18,7 @@ mpl.use('Agg')
 import matplotlib.pyplot as plt
 import itertools
 from scipy import interp
+import train_utils
 
 
 print("Tensorflow version:", tf.__version__)
@@ -27,6 +28,8 @@ parser = argparse.ArgumentParser(description='Model evaluation', formatter_class
 parser.add_argument('--json_tf', type=str, help='JSON file generated by tfRecords.py. Used to evaluate the model.', required=True)
 parser.add_argument('--json', type=str, help='JSON file with model description, created by train.py', required=True)
 parser.add_argument('--translate_label', type=bool, help='Builds translation table from the two json files. Only for classification evaluation and when ground truth differs from model prediction', default=False)
+parser.add_argument('--cache', help='Directory for a cache file of the decoded records, repeated evaluations of the same dataset do not read the tfRecords', type=str, default=None)
+train_utils.add_session_args(parser)
 parser.add_argument('--ps_device', help='Process device', type=str, default='/cpu:0')
 parser.add_argument('--w_device', help='Worker device', type=str, default='/cpu:0')
 
@@ -57,6 +60,8 @@ print('neural_network', neural_network)
 print('ps_device', ps_device)
 print('w_device', w_device)
 
+session_args = dict([(arg, vars(args)[arg]) for arg in train_utils.SESSION_ARGS])
+
 nn = importlib.import_module("nn." + neural_network).NN()
 
 graph = tf.Graph()
@@ -74,9 +79,20 @@ with graph.as_default():
     buffer_size = 100
 
   nn.set_data_description(json_filename=json_tf_records)
+
+  if(args.session_config):
+    session_args = train_utils.load_session_args(args.session_config, train_utils.session_key(neural_network, nn.get_data_description()), session_args)
+  config = train_utils.session_config(**session_args)
   iterator = nn.inputs(batch_size=batch_size,
     num_epochs=1, 
-    buffer_size=buffer_size)
+    buffer_size=buffer_size,
+    num_parallel_reads=model_description.get("num_parallel_reads"),
+    num_parallel_calls=model_description.get("num_parallel_calls"),
+    prefetch_buffer_size=model_description.get("prefetch_buffer_size"),
+    shuffle_files=False,
+    batch_parse=bool(model_description.get("batch_parse", 0)),
+    cache=args.cache,
+    shuffle_mem_mb=model_description.get("shuffle_mem_mb"))
 
   data_tuple = iterator.get_next()
 
@@ -85,7 +101,7 @@ with graph.as_default():
   y_conv = nn.predict(y_conv)
   summary_op = tf.summary.merge_all()
 
-  with tf.Session() as sess:
+  with tf.Session(config=config) as sess:
 
     sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
     saver = tf.train.Saver()
@@ -0,0 +1,132 @@
+import argparse
+import os
+import importlib
+import itertools
+import numpy as np
+import tensorflow as tf
+import sys
+import json
+import time
+
+def run_pipeline(args, batch_size, num_parallel_reads, num_parallel_calls, prefetch_buffer_size):
+	# Runs only the input pipeline of the network and returns the latency of every batch and the number of examples and bytes
+	graph = tf.Graph()
+	with graph.as_default():
+
+		nn = importlib.import_module("nn." + args.nn).NN()
+		nn.set_data_description(json_filename=args.json)
+		iterator = nn.inputs(batch_size=batch_size,
+			num_epochs=None,
+			buffer_size=args.buffer_size,
+			num_parallel_reads=num_parallel_reads,
+			num_parallel_calls=num_parallel_calls,
+			prefetch_buffer_size=prefetch_buffer_size,
+			batch_parse=bool(args.batch_parse),
+			cache=args.cache)
+
+		data_tuple = iterator.get_next()
+
+		with tf.Session() as sess:
+			sess.run([iterator.initializer])
+
+			for step in range(args.warmup):
+				sess.run(data_tuple)
+
+			latency = []
+			num_examples = 0
+			num_bytes = 0
+			for step in range(args.batches):
+				start = time.time()
+				data = sess.run(data_tuple)
+				latency.append(time.time() - start)
+
+				num_examples += len(data[0])
+				num_bytes += sum([np.asarray(d).nbytes for d in data])
+
+	return np.array(latency), num_examples, num_bytes
+
+def check_inference(args):
+	# Builds the graph of the network on the batches of the pipeline, i.e., the decoded records have the static rank and channels the
+	# network needs. Images stored with --variable_shape only have the dimensions that change between images undefined
+	graph = tf.Graph()
+	with graph.as_default():
+
+		nn = importlib.import_module("nn." + args.nn).NN()
+		nn.set_data_description(json_filename=args.json)
+		iterator = nn.inputs(batch_size=args.batch_size[0], num_epochs=None, buffer_size=args.buffer_size, batch_parse=bool(args.batch_parse))
+
+		data_tuple = iterator.get_next()
+		for i, data in enumerate(data_tuple):
+			print("Batch", nn.data_description["data_keys"][i], data.get_shape().as_list())
+
+		nn.inference(data_tuple, is_training=True, ps_device="/cpu:0", w_device="/cpu:0")
+		print("The graph of", args.nn, "was built from the pipeline")
+
+def main(args):
+
+	if(args.inference):
+		check_inference(args)
+
+	results = {}
+	results["json"] = args.json
+	results["nn"] = args.nn
+	results["batches"] = args.batches
+	results["batch_parse"] = args.batch_parse
+	results["cache"] = args.cache
+	results["runs"] = []
+
+	for batch_size, num_parallel_reads, num_parallel_calls, prefetch_buffer_size in itertools.product(args.batch_size, args.num_parallel_reads, args.num_parallel_calls, args.prefetch_buffer_size):
+
+		# -1 lets BaseNN.inputs pick the value, i.e., autotune
+		config = {}
+		config["batch_size"] = batch_size
+		config["num_parallel_reads"] = num_parallel_reads if num_parallel_reads > 0 else None
+		config["num_parallel_calls"] = num_parallel_calls if num_parallel_calls > 0 else None
+		config["prefetch_buffer_size"] = prefetch_buffer_size if prefetch_buffer_size > 0 else None
+
+		try:
+			latency, num_examples, num_bytes = run_pipeline(args, **config)
+		except Exception as e:
+			print("Error running the pipeline", config, e, file=sys.stderr)
+			continue
+
+		elapsed = np.sum(latency)
+
+		result = {}
+		result.update(config)
+		result["examples_per_sec"] = num_examples/elapsed
+		result["mb_per_sec"] = num_bytes/(1024*1024)/elapsed
+		result["latency_ms"] = dict([("p" + str(p), float(np.percentile(latency, p)*1000)) for p in [50, 90, 99]])
+		result["latency_ms"]["max"] = float(np.max(latency)*1000)
+		results["runs"].append(result)
+
+		print("%s: %.1f examples/sec | %.2f MB/sec | p50 = %.2f ms | p99 = %.2f ms" % (config, result["examples_per_sec"], result["mb_per_sec"], result["latency_ms"]["p50"], result["latency_ms"]["p99"]))
+
+	if(len(results["runs"]) > 0):
+		best = max(results["runs"], key=lambda run: run["examples_per_sec"])
+		print("Fastest:", best)
+
+	print("Writing:", args.out)
+	with open(args.out, "w") as f:
+		f.write(json.dumps(results))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Measures the throughput of the input pipeline of a network (BaseNN.inputs) without running the network. Sweeps the batch size, the parallelism and the prefetch depth and writes the results as JSON', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+	parser.add_argument('--json', type=str, help='JSON file created by tfRecords.py', required=True)
+	parser.add_argument('--nn', type=str, help='Type of neural network, the input pipeline of this network is used', default='u_nn')
+	parser.add_argument('--batches', type=int, help='Number of batches measured for each configuration', default=200)
+	parser.add_argument('--warmup', type=int, help='Number of batches read before measuring', default=20)
+	parser.add_argument('--batch_size', nargs="+", type=int, help='Batch sizes', default=[8, 32])
+	parser.add_argument('--num_parallel_reads', nargs="+", type=int, help='Number of files read in parallel, -1 = number of cpus', default=[1, -1])
+	parser.add_argument('--num_parallel_calls', nargs="+", type=int, help='Number of records decoded in parallel, -1 = autotune', default=[1, -1])
+	parser.add_argument('--prefetch_buffer_size', nargs="+", type=int, help='Number of batches prefetched, -1 = autotune', default=[1, 4, -1])
+	parser.add_argument('--buffer_size', type=int, help='Shuffle buffer size', default=1000)
+	parser.add_argument('--batch_parse', type=int, help='Decode the batches with a single parse op, 0 or 1', default=0)
+	parser.add_argument('--cache', type=str, help='"memory" or a directory for the cache of the decoded records', default=None)
+	parser.add_argument('--inference', type=int, help='Check that the network builds its graph from the batches of the pipeline before measuring, e.g., a description written with --variable_shape. 0 or 1', default=0)
+	parser.add_argument('--out', type=str, help='Output JSON file with the results', default="inputs_benchmark.json")
+
+	args = parser.parse_args()
+
+	main(args)
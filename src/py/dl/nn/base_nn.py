@@ -7,7 +7,17 @@ import tensorflow as tf
 import json
 import os
 import glob
+import csv
 import sys
+import re
+import hashlib
+import socket
+
+# Lets tf.data pick the parallelism and the prefetch buffer at runtime. Older versions of tensorflow do not have it
+if(hasattr(tf.data, "experimental") and hasattr(tf.data.experimental, "AUTOTUNE")):
+    AUTOTUNE = tf.data.experimental.AUTOTUNE
+else:
+    AUTOTUNE = None
 
 class BaseNN:
 
@@ -29,12 +39,40 @@ class BaseNN:
 
         if("data_keys" in self.data_description):
             for data_key in self.data_description["data_keys"]:
-                self.keys_to_features[data_key] = tf.FixedLenFeature((np.prod(self.data_description[data_key]["shape"])), eval(self.data_description[data_key]["type"]))
+                if(self.data_description[data_key].get("encoding") == "raw"):
+                    # The pixel buffer is stored as bytes in its native type
+                    self.keys_to_features[data_key] = tf.FixedLenFeature([], tf.string)
+                elif(self.data_description[data_key].get("variable_shape")):
+                    self.keys_to_features[data_key] = tf.VarLenFeature(eval(self.data_description[data_key]["type"]))
+                else:
+                    self.keys_to_features[data_key] = tf.FixedLenFeature((np.prod(self.data_description[data_key]["shape"])), eval(self.data_description[data_key]["type"]))
+
+                if(self.data_description[data_key].get("variable_shape")):
+                    # Shape of the image in the record
+                    self.keys_to_features[data_key + "_shape"] = tf.FixedLenFeature([len(self.data_description[data_key]["shape"])], tf.int64)
         else:
             print("Nothing to decode! data_keys missing in object description object. tfRecords.py creates this descriptor.")
             raise
     def get_data_description(self):
         return self.data_description
+
+    def get_compression_type(self):
+        # Compression of the records written by tfRecords.py, "" if the records are not compressed
+        return self.data_description.get("compression", "")
+
+    def get_label_keys(self):
+        # Keys with label maps or integer values. They are interpolated with nearest neighbor, tfRecords.py --label_keys and --enumerate
+        label_keys = list(self.data_description.get("label_keys", []))
+        if(self.data_description.get("enumerate") and not self.data_description["enumerate"] in label_keys):
+            label_keys.append(self.data_description["enumerate"])
+        for data_key in self.data_description["data_keys"]:
+            if(self.data_description[data_key].get("type") in ["tf.int32", "tf.int64"] and not data_key in label_keys):
+                label_keys.append(data_key)
+        return label_keys
+
+    def get_variable_shape_keys(self):
+        # Keys of the images stored with their own shape, tfRecords.py --variable_shape
+        return [data_key for data_key in self.data_description["data_keys"] if self.data_description[data_key].get("variable_shape")]
     
     def read_and_decode(self, record):
 
@@ -43,23 +81,450 @@ class BaseNN:
 
         if("data_keys" in self.data_description):
             for data_key in self.data_description["data_keys"]:
-                reshaped_parsed.append(tf.reshape(parsed[data_key], self.data_description[data_key]["shape"]))
+                if(self.data_description[data_key].get("variable_shape")):
+                    feature = parsed[data_key]
+                    if(isinstance(feature, tf.SparseTensor)):
+                        feature = tf.sparse_tensor_to_dense(feature)
+                    reshaped = tf.reshape(self.decode_feature(data_key, feature), tf.cast(parsed[data_key + "_shape"], tf.int32))
+                    # The rank and the number of channels stay static, the dimensions that change between images (-1 in the description) are None
+                    reshaped.set_shape([s if s > 0 else None for s in self.data_description[data_key]["shape"]])
+                    reshaped_parsed.append(reshaped)
+                else:
+                    reshaped_parsed.append(tf.reshape(self.decode_feature(data_key, parsed[data_key]), self.data_description[data_key]["shape"]))
 
         return tuple(reshaped_parsed)
 
-    def inputs(self, batch_size=1, num_epochs=1, buffer_size=1000):
+    def read_and_decode_batch(self, records):
+        # Decodes a batch of serialized records with a single parse op. The tuple has the same layout as read_and_decode
+        # with the batch dimension first
+        parsed = tf.parse_example(records, self.keys_to_features)
+        reshaped_parsed = []
+
+        if("data_keys" in self.data_description):
+            for data_key in self.data_description["data_keys"]:
+                reshaped_parsed.append(tf.reshape(self.decode_feature(data_key, parsed[data_key]), [-1] + self.data_description[data_key]["shape"]))
+
+        return tuple(reshaped_parsed)
 
+    def decode_feature(self, data_key, feature):
+        # Features encoded as raw bytes are decoded with their native type and cast to the type in the description
+        if(self.data_description[data_key].get("encoding") == "raw"):
+            feature = tf.decode_raw(feature, eval(self.data_description[data_key]["dtype"]))
+            feature = tf.cast(feature, eval(self.data_description[data_key]["type"]))
+        return feature
+
+    def get_tfrecords(self):
+        # Returns the tfRecord files and a mask of the records to read from each file, one row per file padded with False.
+        # If the description points to a manifest written by tfRecords_split.py, the files are read from it.
+        # Otherwise, the tfrecords directory is walked
         tfrecords_arr = []
-        tfrecords_dir = os.path.join(os.path.dirname(self.json_filename), self.data_description["tfrecords"], '**/*.tfrecord')
-        for tfr in glob.iglob(tfrecords_dir, recursive=True):
-          tfrecords_arr.append(tfr)
+        tfrecords_mask = []
+        json_dir = os.path.dirname(self.json_filename)
+
+        if("manifest" in self.data_description):
+            with open(os.path.join(json_dir, self.data_description["manifest"]), "r") as f:
+                for line in f:
+                    # path or path<TAB>num_records<TAB>index,index... for sharded records
+                    fields = line.rstrip("\n").split("\t")
+                    if(fields[0] == ""):
+                        continue
+                    tfrecords_arr.append(os.path.join(json_dir, fields[0]))
+                    if(len(fields) > 2):
+                        mask = np.zeros(int(fields[1]), dtype=bool)
+                        mask[np.array(fields[2].split(","), dtype=int)] = True
+                    else:
+                        mask = np.ones(1, dtype=bool)
+                    tfrecords_mask.append(mask)
+        else:
+            tfrecords_dir = os.path.join(json_dir, self.data_description["tfrecords"], '**/*.tfrecord')
+            for tfr in glob.iglob(tfrecords_dir, recursive=True):
+              tfrecords_arr.append(tfr)
+
+        return tfrecords_arr, self.pad_masks(tfrecords_mask)
+
+    def get_num_records(self):
+        # Number of records read in one epoch. Sharded records without a manifest are counted with the index csv written by tfRecords.py
+        json_dir = os.path.dirname(self.json_filename)
+        if("manifest" in self.data_description):
+            num_records = 0
+            with open(os.path.join(json_dir, self.data_description["manifest"]), "r") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if(fields[0] == ""):
+                        continue
+                    num_records += len(fields[2].split(",")) if len(fields) > 2 else 1
+            return num_records
+        if("index" in self.data_description):
+            with open(os.path.join(json_dir, self.data_description["index"]), "r") as f:
+                return sum(1 for row in csv.DictReader(f))
+        tfrecords_arr, tfrecords_mask = self.get_tfrecords()
+        return len(tfrecords_arr)
+
+    def pad_masks(self, masks):
+        # Stacks the record masks of the files in a matrix padded with False. None if all the records are read
+        if(len(masks) == 0 or np.all(np.concatenate(masks))):
+            return None
+        mask = np.zeros([len(masks), max([len(m) for m in masks])], dtype=bool)
+        for file_index, m in enumerate(masks):
+            mask[file_index, 0:len(m)] = m
+        return mask
+
+    def get_class_tfrecords(self, tfrecords_arr, tfrecords_mask=None):
+        # Returns the files and the record masks of every class. They are read from the class manifest written by tfRecords.py
+        # and restricted to the records in tfrecords_arr and tfrecords_mask, i.e., a split
+        json_dir = os.path.dirname(self.json_filename)
+        enumerate_description = self.data_description[self.data_description["enumerate"]]
+
+        selected = {}
+        for file_index, tfrecord in enumerate(tfrecords_arr):
+            selected[os.path.normpath(tfrecord)] = tfrecords_mask[file_index] if tfrecords_mask is not None else None
+
+        class_tfrecords = {}
+        with open(os.path.join(json_dir, enumerate_description["class_manifest"]), "r") as f:
+            for line in f:
+                # class<TAB>path or class<TAB>path<TAB>num_records<TAB>index,index... for sharded records
+                fields = line.rstrip("\n").split("\t")
+                if(len(fields) < 2):
+                    continue
+                tfrecord = os.path.join(json_dir, fields[1])
+                if(not os.path.normpath(tfrecord) in selected):
+                    continue
+                if(len(fields) > 3):
+                    mask = np.zeros(int(fields[2]), dtype=bool)
+                    mask[np.array(fields[3].split(","), dtype=int)] = True
+                else:
+                    mask = np.ones(1, dtype=bool)
+
+                split_mask = selected[os.path.normpath(tfrecord)]
+                if(split_mask is not None):
+                    num_records = min(len(mask), len(split_mask))
+                    mask[num_records:] = False
+                    mask[0:num_records] &= split_mask[0:num_records]
+
+                if(np.any(mask)):
+                    class_number = int(fields[0])
+                    if(not class_number in class_tfrecords):
+                        class_tfrecords[class_number] = ([], [])
+                    class_tfrecords[class_number][0].append(tfrecord)
+                    class_tfrecords[class_number][1].append(mask)
+
+        return class_tfrecords
+
+    def sample_classes(self, tfrecords_arr, tfrecords_mask, class_sampling, num_parallel_reads=1):
+        # Dataset of serialized records sampled from one dataset per class. class_sampling is "balanced" or a dictionary
+        # with the weight of every class name, the classes that are not in the dictionary have weight 1.
+        # The class datasets repeat forever, returns the dataset and the number of records in the split
+        class_tfrecords = self.get_class_tfrecords(tfrecords_arr, tfrecords_mask)
+        if(len(class_tfrecords) == 0):
+            raise Exception("There are no records in the class manifest, convert the dataset with tfRecords.py --enumerate")
+
+        class_names = {}
+        for class_name, class_number in self.data_description[self.data_description["enumerate"]]["class"].items():
+            class_names[class_number] = class_name
+
+        datasets = []
+        weights = []
+        num_records = 0
+        for class_number in sorted(class_tfrecords):
+            class_arr, class_mask = class_tfrecords[class_number]
+            num_records += int(np.sum([np.sum(mask) for mask in class_mask]))
+            datasets.append(self.interleave_tfrecords(class_arr, self.pad_masks(class_mask), num_parallel_reads=max(1, num_parallel_reads//len(class_tfrecords)), repeat=True))
+            if(class_sampling == "balanced"):
+                weights.append(1.0)
+            else:
+                weights.append(float(class_sampling.get(class_names[class_number], 1.0)))
+
+        weights = (np.array(weights)/np.sum(weights)).tolist()
+        print("Class sampling weights", dict([(class_names[class_number], weight) for class_number, weight in zip(sorted(class_tfrecords), weights)]))
+
+        return tf.contrib.data.sample_from_datasets(datasets, weights=weights), num_records
+
+    def interleave_tfrecords(self, tfrecords_arr, tfrecords_mask=None, num_parallel_reads=1, shuffle_files=True, repeat=False):
+        # Records are read from num_parallel_reads files at the same time. If the files are not shuffled, the order is deterministic
+        if(tfrecords_mask is not None):
+            tfrecords_mask = tf.constant(tfrecords_mask)
+
+        dataset = tf.data.Dataset.from_tensor_slices((tfrecords_arr, np.arange(len(tfrecords_arr))))
+        if(shuffle_files):
+            # The order of the files changes every epoch
+            dataset = dataset.shuffle(buffer_size=len(tfrecords_arr))
+        if(repeat):
+            dataset = dataset.repeat()
+
+        return dataset.apply(tf.contrib.data.parallel_interleave(lambda tfrecord, file_index: self.read_tfrecord(tfrecord, file_index, tfrecords_mask), cycle_length=max(1, min(num_parallel_reads, len(tfrecords_arr))), sloppy=shuffle_files))
+
+    def augment(self, data, augmentation):
+        # Random transformations of the images of a decoded record. The geometric transformations use the same random parameters
+        # for all the images of the record, i.e., image/image1 or image/label map. The intensity transformations only change the first image
+        # augmentation: {"flip": [spatial axes], "translate": pixels, "rotate": degrees, "gain": fraction, "contrast": fraction, "noise": std}
+        # The flip and the translation move whole pixels, the rotation interpolates the label maps (get_label_keys) with nearest neighbor
+        data = list(data)
+        data_keys = self.data_description["data_keys"]
+        label_keys = self.get_label_keys()
+
+        image_indices = [i for i, key in enumerate(data_keys) if "max" in self.data_description[key] and len(self.data_description[key]["shape"]) >= 3]
+        if(len(image_indices) == 0):
+            return tuple(data)
+
+        spatial_dims = len(self.data_description[data_keys[image_indices[0]]]["shape"]) - 1
+
+        if("flip" in augmentation):
+            for axis in augmentation["flip"]:
+                flip = tf.random_uniform([]) < 0.5
+                for i in image_indices:
+                    data[i] = tf.cond(flip, lambda: tf.reverse(data[i], [axis]), lambda: data[i])
+
+        if("translate" in augmentation):
+            # The images are padded and cropped at a random offset
+            translate = np.broadcast_to(augmentation["translate"], [spatial_dims]).astype(int)
+            offset = tf.cast(tf.floor(tf.random_uniform([spatial_dims])*(2*translate + 1)), tf.int32)
+            for i in image_indices:
+                padded = tf.pad(data[i], [[t, t] for t in translate] + [[0, 0]])
+                data[i] = tf.slice(padded, tf.concat([offset, [0]], 0), tf.shape(data[i]))
+
+        if("rotate" in augmentation and spatial_dims == 2):
+            angle = tf.random_uniform([], -1, 1)*augmentation["rotate"]*np.pi/180
+            for i in image_indices:
+                # Label maps are rotated with nearest neighbor interpolation
+                data[i] = tf.contrib.image.rotate(data[i], angle, interpolation="NEAREST" if data_keys[i] in label_keys else "BILINEAR")
+
+        i = image_indices[0]
+        if(not data_keys[i] in label_keys):
+            if("gain" in augmentation):
+                data[i] = data[i]*tf.random_uniform([], 1 - augmentation["gain"], 1 + augmentation["gain"])
+
+            if("contrast" in augmentation):
+                mean = tf.reduce_mean(data[i])
+                data[i] = (data[i] - mean)*tf.random_uniform([], 1 - augmentation["contrast"], 1 + augmentation["contrast"]) + mean
+
+            if("noise" in augmentation):
+                # Speckle, multiplicative noise
+                data[i] = data[i]*(1 + tf.random_normal(tf.shape(data[i]), stddev=augmentation["noise"]))
+
+        return tuple(data)
+
+    def batch(self, dataset, batch_size, num_buckets=8):
+        # Images with variable shape are bucketed by their number of pixels, each batch is padded to its largest image
+        variable_shape_keys = self.get_variable_shape_keys()
+        if(len(variable_shape_keys) == 0):
+            return dataset.batch(batch_size)
+
+        data_key = variable_shape_keys[0]
+        key_index = self.data_description["data_keys"].index(data_key)
+        min_size = np.prod(self.data_description[data_key]["min_shape"][0:-1])
+        max_size = np.prod(self.data_description[data_key]["max_shape"][0:-1])
+        bucket_boundaries = np.unique(np.geomspace(min_size, max_size, num_buckets + 1)[1:-1].astype(int) + 1).tolist()
+
+        if(len(bucket_boundaries) == 0):
+            return dataset.padded_batch(batch_size, padded_shapes=dataset.output_shapes)
+
+        return dataset.apply(tf.contrib.data.bucket_by_sequence_length(
+            lambda *data: tf.reduce_prod(tf.shape(data[key_index])[0:-1]),
+            bucket_boundaries,
+            [batch_size]*(len(bucket_boundaries) + 1)))
+
+    def get_record_size(self, serialized=False):
+        # Bytes of a decoded record or, if serialized, an estimate of the bytes of the record in the tfRecord.
+        # The largest shape is used for images with variable shape
+        record_size = 0
+        for data_key in self.data_description["data_keys"]:
+            description = self.data_description[data_key]
+            num_values = np.prod(description.get("max_shape", description["shape"]))
+            if(serialized and description.get("encoding") == "raw"):
+                value_size = np.dtype(description["dtype"].replace("tf.", "")).itemsize
+            elif(description["type"] == "tf.string"):
+                value_size = 1
+            else:
+                value_size = np.dtype(description["type"].replace("tf.", "")).itemsize
+            record_size += num_values*value_size
+        return max(1, int(record_size))
+
+    def get_shuffle_buffer_size(self, shuffle_mem_mb, serialized=False, buffer_size=None):
+        # Number of records that fit in shuffle_mem_mb
+        shuffle_buffer_size = max(1, int(shuffle_mem_mb*1024*1024/self.get_record_size(serialized)))
+        if(buffer_size):
+            return min(shuffle_buffer_size, buffer_size)
+        return shuffle_buffer_size
+
+    def get_cache_filename(self, cache_dir, tfrecords_arr, tfrecords_mask=None):
+        # The cache file name has a key computed from the description, the names of the record files and the files written by
+        # tfRecords.py and tfRecords_split.py when the records change, i.e., the conversion manifest, the split manifest and the index.
+        # The record files are not opened or stat'ed. If the dataset changes, the key changes and the caches of the same description
+        # with a different key are deleted, unless another process is writing them.
+        # Returns None if another process is writing the cache, the records are read from the files
+        json_dir = os.path.dirname(self.json_filename)
+        key = hashlib.sha1(json.dumps(self.data_description, sort_keys=True).encode())
+        for tfrecord in sorted(tfrecords_arr):
+            key.update(tfrecord.encode())
+        for dataset_file in [self.data_description.get("manifest"), self.data_description.get("index"), self.data_description["tfrecords"] + "_manifest.json"]:
+            if(dataset_file and os.path.exists(os.path.join(json_dir, dataset_file))):
+                stat = os.stat(os.path.join(json_dir, dataset_file))
+                key.update((dataset_file + str(stat.st_size) + str(stat.st_mtime)).encode())
+        if(tfrecords_mask is not None):
+            key.update(tfrecords_mask.tobytes())
+
+        cache_prefix = os.path.splitext(os.path.basename(self.json_filename))[0] + "-"
+        cache_name = cache_prefix + key.hexdigest()
+        cache_filename = os.path.join(cache_dir, cache_name)
+
+        if(not os.path.exists(cache_dir)):
+            os.makedirs(cache_dir)
+
+        # Only the files of this description are removed, i.e., us-<key> and not us-2019-<key>
+        cache_pattern = re.compile(re.escape(cache_prefix) + "[0-9a-f]{40}([._].*)?$")
+        stale_caches = set()
+        for cache_file in glob.glob(os.path.join(cache_dir, cache_prefix + "*")):
+            if(cache_pattern.match(os.path.basename(cache_file)) and not os.path.basename(cache_file).startswith(cache_name)):
+                stale_caches.add(os.path.join(cache_dir, os.path.basename(cache_file)[0:len(cache_prefix) + 40]))
+        for stale_cache in sorted(stale_caches):
+            if(self.is_cache_locked(stale_cache)):
+                print("Keeping stale cache, it is being written by another process", stale_cache, file=sys.stderr)
+                continue
+            for cache_file in glob.glob(stale_cache + "*"):
+                print("Removing stale cache", cache_file)
+                os.remove(cache_file)
+
+        # A cache that was being written by a training that was killed has a lockfile, tensorflow does not write it again
+        # while the lockfile exists. The lockfile is only removed if the process that wrote it is dead.
+        # If the cache is not complete, i.e., it has no index, the partial files are removed
+        if(len(glob.glob(cache_filename + "*.lockfile")) > 0):
+            if(self.is_cache_locked(cache_filename)):
+                print("The cache is being written by another process, the records are read from the files", cache_filename, file=sys.stderr)
+                return None
+            print("Removing the lockfile of an interrupted cache", cache_filename)
+            for lockfile in glob.glob(cache_filename + "*.lockfile"):
+                os.remove(lockfile)
+            if(len(glob.glob(cache_filename + "*.index")) == 0):
+                for cache_file in glob.glob(cache_filename + "*"):
+                    os.remove(cache_file)
+
+        if(len(glob.glob(cache_filename + "*.index")) == 0):
+            # This process writes the cache
+            with open(cache_filename + ".owner", "w") as f:
+                json.dump({"pid": os.getpid(), "host": socket.gethostname()}, f)
+
+        return cache_filename
+
+    def is_cache_locked(self, cache_filename):
+        # True if the cache has a lockfile and the process that writes it is alive or unknown, i.e., on another host.
+        # The process is in <cache>.owner
+        if(len(glob.glob(cache_filename + "*.lockfile")) == 0):
+            return False
+        try:
+            with open(cache_filename + ".owner", "r") as f:
+                owner = json.load(f)
+        except (IOError, ValueError):
+            return True
+        if(owner.get("host") != socket.gethostname() or owner.get("pid") == os.getpid()):
+            return True
+        try:
+            os.kill(owner["pid"], 0)
+        except ProcessLookupError:
+            return False
+        except OSError:
+            # The process exists but belongs to another user
+            return True
+        return True
+
+    def read_tfrecord(self, tfrecord, file_index, tfrecords_mask=None):
+        # Dataset with the records of one file. The shards are shared by the splits, only the records in the manifest are kept
+        dataset = tf.data.TFRecordDataset(tfrecord, compression_type=self.get_compression_type())
+
+        if(tfrecords_mask is not None):
+            dataset = tf.data.Dataset.zip((dataset, tf.data.Dataset.from_tensor_slices(tf.gather(tfrecords_mask, file_index))))
+            dataset = dataset.filter(lambda record, keep: keep)
+            dataset = dataset.map(lambda record, keep: record)
+
+        return dataset
+
+    def inputs(self, batch_size=1, num_epochs=1, buffer_size=1000, num_parallel_reads=None, num_parallel_calls=None, prefetch_buffer_size=None, shuffle_files=True, batch_parse=False, cache=None, augmentation=None, class_sampling=None, shuffle_mem_mb=None):
+        # num_parallel_reads: number of record files read at the same time. num_parallel_calls: number of records decoded in parallel
+        # prefetch_buffer_size: number of batches prepared while the model runs. None picks the values at runtime
+        # batch_parse: the serialized records are batched first and each batch is decoded with read_and_decode_batch
+        # cache: "memory" or a directory. The decoded records are cached in the first epoch, the next epochs do not read the files
+        # augmentation: dictionary with the random transformations applied to every record after decoding, see augment
+        # class_sampling: "balanced" or a dictionary with the weight of every class name, see sample_classes
+        # shuffle_mem_mb: memory budget of the shuffle buffers. The serialized records are shuffled first, then a small buffer of decoded records
+
+        tfrecords_arr, tfrecords_mask = self.get_tfrecords()
+
+        if(num_parallel_reads is None):
+            num_parallel_reads = os.cpu_count()
+
+        if(num_parallel_calls is None):
+            num_parallel_calls = AUTOTUNE if AUTOTUNE is not None else os.cpu_count()
+
+        if(prefetch_buffer_size is None):
+            prefetch_buffer_size = AUTOTUNE if AUTOTUNE is not None else 1
+
+        if(class_sampling):
+            # The sampled records are different every epoch, they are not cached
+            cache = None
+
+        serialized_buffer_size = None
+        if(shuffle_mem_mb):
+            # Half of the budget is used by the serialized records, the other half by the decoded records.
+            # Records stored with raw encoding are smaller than the decoded tensors, more of them fit in the first buffer
+            serialized_buffer_size = self.get_shuffle_buffer_size(shuffle_mem_mb/2.0, serialized=True)
+            buffer_size = self.get_shuffle_buffer_size(shuffle_mem_mb/2.0, buffer_size=buffer_size)
+            print("Shuffle buffers: serialized records", serialized_buffer_size, "decoded records", buffer_size)
+
+        cache_filename = None
+        if(cache and cache != "memory"):
+            cache_filename = self.get_cache_filename(cache, tfrecords_arr, tfrecords_mask)
+            if(cache_filename is None):
+                cache = None
+
+        if(batch_parse and len(self.get_variable_shape_keys()) > 0):
+            # The records are reshaped one at a time, the batches are padded to the largest image
+            batch_parse = False
+
+        if(class_sampling):
+            # An epoch has the same number of records as the split, the rare classes are seen more often
+            dataset, num_records = self.sample_classes(tfrecords_arr, tfrecords_mask, class_sampling, num_parallel_reads=num_parallel_reads)
+            if(num_epochs is not None):
+                dataset = dataset.take(num_records*num_epochs)
+            # The sampled dataset repeats forever if num_epochs is None
+            num_epochs = 1
+        else:
+            dataset = self.interleave_tfrecords(tfrecords_arr, tfrecords_mask, num_parallel_reads=num_parallel_reads, shuffle_files=shuffle_files)
+
+        if(serialized_buffer_size):
+            dataset = dataset.shuffle(buffer_size=serialized_buffer_size)
+
+        if(cache or augmentation):
+            if(batch_parse):
+                # The batches are decoded and split again, the records are cached, augmented and shuffled individually
+                dataset = dataset.batch(batch_size)
+                dataset = dataset.map(self.read_and_decode_batch, num_parallel_calls=num_parallel_calls)
+                dataset = dataset.apply(tf.contrib.data.unbatch())
+            else:
+                dataset = dataset.map(self.read_and_decode, num_parallel_calls=num_parallel_calls)
+
+            # After the first epoch the records come from the cache in the order of the first epoch, the files are not shuffled again.
+            # Only the buffer of decoded records shuffles them, use a larger buffer_size or shuffle_mem_mb with the cache
+            if(cache_filename):
+                dataset = dataset.cache(cache_filename)
+            elif(cache):
+                dataset = dataset.cache()
+
+            if(augmentation):
+                # The augmentation runs after the cache, every epoch has new random transformations
+                dataset = dataset.map(lambda *data: self.augment(data, augmentation), num_parallel_calls=num_parallel_calls)
+
+            dataset = dataset.shuffle(buffer_size=buffer_size)
+            dataset = self.batch(dataset, batch_size)
+        elif(batch_parse):
+            dataset = dataset.shuffle(buffer_size=buffer_size)
+            dataset = dataset.batch(batch_size)
+            dataset = dataset.map(self.read_and_decode_batch, num_parallel_calls=num_parallel_calls)
+        else:
+            dataset = dataset.map(self.read_and_decode, num_parallel_calls=num_parallel_calls)
+            dataset = dataset.shuffle(buffer_size=buffer_size)
+            dataset = self.batch(dataset, batch_size)
 
-        dataset = tf.data.TFRecordDataset(tfrecords_arr)
-        
-        dataset = dataset.map(self.read_and_decode)
-        dataset = dataset.shuffle(buffer_size=buffer_size)
-        dataset = dataset.batch(batch_size)
         dataset = dataset.repeat(num_epochs)
+        dataset = dataset.prefetch(prefetch_buffer_size)
         iterator = dataset.make_initializable_iterator()
 
         return iterator
@@ -54,20 +54,17 @@ class NN(base_nn.BaseNN):
 
         conv4_0 = self.convolution3d(pool3_0, name="conv4_0_op", filter_shape=[3, 3, 3, 64, 64], strides=[1,1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
         conv4_1 = self.convolution3d(conv4_0, name="conv4_1_op", filter_shape=[3, 3, 3, 64, 64], strides=[1,1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
-        up_out_shape_4 = conv3_0.get_shape().as_list()
-        up_out_shape_4[0] = batch_size
+        up_out_shape_4 = tf.shape(conv3_0)
         up_conv4_0 = self.up_convolution3d(conv4_0, name="up_conv4_0_op", filter_shape=[3, 3, 3, 64, 64], output_shape=up_out_shape_4, strides=[1,2,2,2,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)        
 
         conv5_0 = self.convolution3d(up_conv4_0, name="conv5_0_op", filter_shape=[3, 3, 3, 64, 64], strides=[1,1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
         conv5_1 = self.convolution3d(conv5_0, name="conv5_1_op", filter_shape=[3, 3, 3, 64, 64], strides=[1,1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
-        up_out_shape_5 = conv2_0.get_shape().as_list()
-        up_out_shape_5[0] = batch_size
+        up_out_shape_5 = tf.shape(conv2_0)
         up_conv5_0 = self.up_convolution3d(conv5_0, name="up_conv5_0_op", filter_shape=[3, 3, 3, 32, 64], output_shape=up_out_shape_5, strides=[1,2,2,2,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
 
         conv6_0 = self.convolution3d(up_conv5_0, name="conv6_0_op", filter_shape=[3, 3, 3, 32, 32], strides=[1,1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
         conv6_1 = self.convolution3d(conv6_0, name="conv6_1_op", filter_shape=[3, 3, 3, 32, 32], strides=[1,1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
-        up_out_shape_6 = conv1_0.get_shape().as_list()
-        up_out_shape_6[0] = batch_size
+        up_out_shape_6 = tf.shape(conv1_0)
         up_conv6_0 = self.up_convolution3d(conv6_0, name="up_conv6_0_op", filter_shape=[3, 3, 3, 16, 32], output_shape=up_out_shape_6, strides=[1,2,2,2,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
 
         conv7_0 = self.convolution3d(up_conv6_0, name="conv7_0_op", filter_shape=[3, 3, 3, 16, 16], strides=[1,1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
@@ -30,7 +30,7 @@ class ReadAndDecode:
         return image, image1
 
 
-def inputs(json_filename, batch_size=1, num_epochs=1):
+def inputs(json_filename, batch_size=1, num_epochs=1, buffer_size=10000, shuffle_mem_mb=None):
 
     r_a_d = ReadAndDecode()
 
@@ -45,10 +45,17 @@ def inputs(json_filename, batch_size=1, num_epochs=1):
         r_a_d.image_shape = obj['image_shape']
         r_a_d.image1_shape = obj['image1_shape']
 
-    dataset = tf.data.TFRecordDataset(tfrecords_arr)
+    if(shuffle_mem_mb):
+        # Number of decoded float32 records that fit in the memory budget
+        buffer_size = max(1, min(buffer_size, int(shuffle_mem_mb*1024*1024/(4*(np.prod(obj["image_shape"]) + np.prod(obj["image1_shape"]))))))
+
+    # The order of the files changes every epoch
+    dataset = tf.data.Dataset.from_tensor_slices(tfrecords_arr)
+    dataset = dataset.shuffle(buffer_size=len(tfrecords_arr))
+    dataset = dataset.flat_map(lambda tfrecord: tf.data.TFRecordDataset(tfrecord, compression_type=obj.get("compression", "")))
     
     dataset = dataset.map(r_a_d.read_and_decode)
-    dataset = dataset.shuffle(buffer_size=10000)
+    dataset = dataset.shuffle(buffer_size=buffer_size)
     dataset = dataset.batch(batch_size)
     dataset = dataset.repeat(num_epochs)
     iterator = dataset.make_initializable_iterator()
@@ -38,7 +38,7 @@ class ReadAndDecode:
 
         return reshaped_parsed["image"], reshaped_parsed["image1"]
 
-def inputs(json_filename, batch_size=1, num_epochs=1):
+def inputs(json_filename, batch_size=1, num_epochs=1, buffer_size=10000, shuffle_mem_mb=None):
 
     with open(json_filename, "r") as f:
         obj = json.load(f)
@@ -51,10 +51,17 @@ def inputs(json_filename, batch_size=1, num_epochs=1):
         for tfr in glob.iglob(tfrecords_dir, recursive=True):
           tfrecords_arr.append(tfr)
 
-    dataset = tf.data.TFRecordDataset(tfrecords_arr)
+    if(shuffle_mem_mb):
+        # Number of decoded float32 records that fit in the memory budget
+        buffer_size = max(1, min(buffer_size, int(shuffle_mem_mb*1024*1024/(4*np.sum([np.prod(obj[img_key + "_shape"]) for img_key in obj["image_keys"]])))))
+
+    # The order of the files changes every epoch
+    dataset = tf.data.Dataset.from_tensor_slices(tfrecords_arr)
+    dataset = dataset.shuffle(buffer_size=len(tfrecords_arr))
+    dataset = dataset.flat_map(lambda tfrecord: tf.data.TFRecordDataset(tfrecord, compression_type=obj.get("compression", "")))
     
     dataset = dataset.map(r_a_d.read_and_decode)
-    dataset = dataset.shuffle(buffer_size=10000)
+    dataset = dataset.shuffle(buffer_size=buffer_size)
     dataset = dataset.batch(batch_size)
     dataset = dataset.repeat(num_epochs)
     iterator = dataset.make_initializable_iterator()
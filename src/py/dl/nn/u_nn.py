@@ -11,6 +11,13 @@ from . import base_nn
 
 class NN(base_nn.BaseNN):
 
+    def get_label_keys(self):
+        # The second data key is the segmentation target
+        label_keys = super(NN, self).get_label_keys()
+        if(len(self.data_description["data_keys"]) > 1 and not self.data_description["data_keys"][1] in label_keys):
+            label_keys.append(self.data_description["data_keys"][1])
+        return label_keys
+
     def inference(self, data_tuple=None, images=None, keep_prob=1, is_training=False, ps_device="/cpu:0", w_device="/gpu:0"):
 
     #   input: tensor of images
@@ -42,24 +49,21 @@ class NN(base_nn.BaseNN):
 
         conv4_0 = self.convolution2d(pool3_0, name="conv4_0_op", filter_shape=[5, 5, 32, 64], strides=[1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
         conv4_1 = self.convolution2d(conv4_0, name="conv4_1_op", filter_shape=[5, 5, 64, 64], strides=[1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
-        up_out_shape_4 = conv3_1.get_shape().as_list()
-        up_out_shape_4[0] = batch_size
+        up_out_shape_4 = tf.shape(conv3_1)
         up_conv4_0 = self.up_convolution2d(conv4_1, name="up_conv4_0_op", filter_shape=[5, 5, 32, 64], output_shape=up_out_shape_4, strides=[1,2,2,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
         
         concat5_0 = tf.concat([up_conv4_0, conv3_1], -1)
 
         conv5_0 = self.convolution2d(concat5_0, name="conv5_0_op", filter_shape=[5, 5, 64, 32], strides=[1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
         conv5_1 = self.convolution2d(conv5_0, name="conv5_1_op", filter_shape=[5, 5, 32, 32], strides=[1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
-        up_out_shape_5 = conv2_1.get_shape().as_list()
-        up_out_shape_5[0] = batch_size
+        up_out_shape_5 = tf.shape(conv2_1)
         up_conv5_0 = self.up_convolution2d(conv5_1, name="up_conv5_0_op", filter_shape=[5, 5, 16, 32], output_shape=up_out_shape_5, strides=[1,2,2,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
         
         concat6_0 = tf.concat([up_conv5_0, conv2_1], -1)
 
         conv6_0 = self.convolution2d(concat6_0, name="conv6_0_op", filter_shape=[5, 5, 32, 16], strides=[1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
         conv6_1 = self.convolution2d(conv6_0, name="conv6_1_op", filter_shape=[5, 5, 16, 16], strides=[1,1,1,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
-        up_out_shape_6 = conv1_1.get_shape().as_list()
-        up_out_shape_6[0] = batch_size
+        up_out_shape_6 = tf.shape(conv1_1)
         up_conv6_0 = self.up_convolution2d(conv6_1, name="up_conv6_0_op", filter_shape=[5, 5, 8, 16], output_shape=up_out_shape_6, strides=[1,2,2,1], padding="SAME", activation=tf.nn.relu, ps_device=ps_device, w_device=w_device)
         
         concat7_0 = tf.concat([up_conv6_0, conv1_1], -1)
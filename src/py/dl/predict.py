@@ -11,6 +11,8 @@ import glob
 import itk
 import sys
 import csv
+import tfRecords
+import train_utils
 
 print("Tensorflow version:", tf.__version__)
 
@@ -35,6 +37,8 @@ parser.add_argument('--out_ext', type=str, help='Output extension for images', d
 parser.add_argument('--out_basename', type=bool, default=False, help='Keeps only the filename for the output, i.e, does not create a directory structure for the output image filename')
 parser.add_argument('--ow', type=int, help='Overwrite outputs', default=1)
 parser.add_argument('--resize', nargs="+", type=int, help='Resize images during prediction, useful when doing whole directories with images of diferent sizes. This is needed to set the value of the placeholder for tensorflow. e.x. 1500 1500. The image will be resized for the prediction but the original image size will be stored. Do not include the channels/pixel components in the resize parameters', default=None)
+parser.add_argument('--resize_mode', type=str, help='Resize mode used with --resize, by default the mode used by tfRecords.py to create the training set. pad and crop place the image at the origin, resample interpolates the image and the prediction is resampled back to the image size', default=None, choices=["pad", "crop", "resample"])
+train_utils.add_session_args(parser)
 parser.add_argument('--ps_device', help='Process device', type=str, default='/cpu:0')
 parser.add_argument('--w_device', help='Worker device', type=str, default='/cpu:0')
 
@@ -81,6 +85,11 @@ nn = importlib.import_module("nn." + neural_network).NN()
 if(data_description):
   nn.set_data_description(data_description=data_description)
 
+session_args = dict([(arg, vars(args)[arg]) for arg in train_utils.SESSION_ARGS])
+if(args.session_config and "data_keys" in data_description):
+  session_args = train_utils.load_session_args(args.session_config, train_utils.session_key(neural_network, data_description), session_args)
+config = train_utils.session_config(**session_args)
+
 class_prediction = False
 class_prediction_arr = []
 if("enumerate" in data_description):
@@ -210,9 +219,20 @@ elif("resize" in data_description):
   resize_shape = data_description["resize"]
 
 if(resize_shape):
-  tf_img_shape = [1] + resize_shape + [tf_img_shape[-1]]
+  tf_img_shape = [1] + list(resize_shape) + [tf_img_shape[-1]]
+
+resize_mode = args.resize_mode
+if(resize_mode is None):
+  resize_mode = data_description.get("resize_mode", "pad")
+
+# Label maps of the training set, the images and the predictions of these keys are resampled with nearest neighbor
+label_keys = data_description.get("label_keys", [])
+data_keys = data_description.get("data_keys", [])
+input_order = 0 if len(data_keys) > 0 and data_keys[0] in label_keys else 1
+output_label = len(data_keys) > 1 and data_keys[1] in label_keys
 
 print("resize_shape", resize_shape)
+print("resize_mode", resize_mode)
 print("tf_img_shape", tf_img_shape)
 
 graph = tf.Graph()
@@ -231,7 +251,7 @@ with graph.as_default():
 
   label = nn.predict(y_conv)
 
-  with tf.Session() as sess:
+  with tf.Session(config=config) as sess:
 
     sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
     saver = tf.train.Saver()
@@ -248,19 +268,9 @@ with graph.as_default():
         img, img_np, img_shape_current = image_read(img_obj["img"])
 
         if(resize_shape):
-          
-          img_np_x = np.zeros(tf_img_shape)
-
-          prediction_shape = []
-          for r_s, i_s in zip(tf_img_shape, img_shape_current):
-            if(r_s >= i_s):
-              prediction_shape.append("0:" + str(i_s))
-            else:
-              print("The resize shape is smaller than the current image shape...", img_obj["img"], file=sys.stderr)
-              prediction_shape.append("0:")
-
-          assign_img = "img_np_x[" + ",".join(prediction_shape) + "]=np.reshape(img_np, img_shape_current)"
-          exec(assign_img)
+          # The image is placed at the origin, images larger than the resize shape are cropped
+          img_np_x = tfRecords.resize_image(np.reshape(img_np, img_shape_current[1:]), resize_shape, mode="resample" if resize_mode == "resample" else "crop", order=input_order)
+          img_np_x = np.reshape(img_np_x, tf_img_shape)
         else:
           img_np_x = np.reshape(img_np, tf_img_shape)
 
@@ -274,8 +284,9 @@ with graph.as_default():
             })
         elif(nn.prediction_type() == "image" or nn.prediction_type() == "segmentation"):
           if(resize_shape):
-            assign_img = "label_map=label_map[" + ",".join(prediction_shape) + "]"
-            exec(assign_img)
+            # Back to the size of the input image, segmentations are resampled with nearest neighbor interpolation
+            label_map = np.array(label_map[0])
+            label_map = tfRecords.resize_image(np.reshape(label_map, label_map.shape[1:]), img_shape_current[1:-1], mode="resample" if resize_mode == "resample" else "crop", order=0 if output_label or nn.prediction_type() == "segmentation" else 1)
 
           #THE NUMBER OF CHANNELS OF THE OUTPUT ARE GIVEN BY THE NEURAL NET
           label_map = np.array(label_map)
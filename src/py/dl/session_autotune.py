@@ -0,0 +1,134 @@
+import argparse
+import os
+import importlib
+import itertools
+import subprocess
+import numpy as np
+import tensorflow as tf
+import sys
+import json
+import time
+import train_utils
+
+def run_config(args, session_args):
+	# Trains the network for a few steps with the session configuration and returns the time of every step.
+	# Runs in its own process, tensorflow creates the thread pools once per process
+	config = train_utils.session_config(**session_args)
+
+	graph = tf.Graph()
+	with graph.as_default():
+
+		nn = importlib.import_module("nn." + args.nn).NN()
+		nn.set_data_description(json_filename=args.json)
+		iterator = nn.inputs(batch_size=args.batch_size,
+			num_epochs=None,
+			buffer_size=args.buffer_size)
+
+		data_tuple = iterator.get_next()
+		keep_prob = tf.placeholder(tf.float32)
+
+		y_conv = nn.inference(data_tuple, keep_prob=keep_prob, is_training=True)
+		loss = nn.loss(y_conv, data_tuple)
+		train_step = nn.training(loss, args.learning_rate)
+
+		with tf.Session(config=config) as sess:
+			sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
+			sess.run([iterator.initializer])
+
+			for step in range(args.warmup):
+				sess.run(train_step, feed_dict={keep_prob: 0.5})
+
+			step_times = []
+			for step in range(args.steps):
+				start = time.time()
+				sess.run(train_step, feed_dict={keep_prob: 0.5})
+				step_times.append(time.time() - start)
+
+	return step_times
+
+def main(args):
+
+	if(args.worker):
+		step_times = run_config(args, json.loads(args.worker))
+		print(json.dumps({"step_times": step_times}))
+		return
+
+	nn = importlib.import_module("nn." + args.nn).NN()
+	nn.set_data_description(json_filename=args.json)
+	key = train_utils.session_key(args.nn, nn.get_data_description())
+
+	runs = []
+
+	for intra_op_threads, inter_op_threads, omp_threads, kmp_blocktime in itertools.product(args.intra_op_threads, args.inter_op_threads, args.omp_threads, args.kmp_blocktime):
+
+		# -1 keeps the default of tensorflow or the OpenMP runtime
+		session_args = {}
+		session_args["intra_op_threads"] = intra_op_threads if intra_op_threads > 0 else None
+		session_args["inter_op_threads"] = inter_op_threads if inter_op_threads > 0 else None
+		session_args["cpu_affinity"] = args.cpu_affinity
+		session_args["omp_threads"] = omp_threads if omp_threads > 0 else None
+		session_args["kmp_blocktime"] = kmp_blocktime if kmp_blocktime >= 0 else None
+		session_args["kmp_affinity"] = args.kmp_affinity
+
+		worker_args = [sys.executable, os.path.abspath(__file__), "--json", args.json, "--nn", args.nn, "--batch_size", str(args.batch_size), "--buffer_size", str(args.buffer_size), "--learning_rate", str(args.learning_rate), "--steps", str(args.steps), "--warmup", str(args.warmup), "--worker", json.dumps(session_args)]
+
+		process = subprocess.run(worker_args, stdout=subprocess.PIPE, universal_newlines=True)
+		if(process.returncode != 0):
+			print("Error running the configuration", session_args, file=sys.stderr)
+			continue
+
+		step_times = json.loads(process.stdout.strip().split("\n")[-1])["step_times"]
+
+		run = {}
+		run.update(session_args)
+		run["steps_per_sec"] = len(step_times)/np.sum(step_times)
+		run["examples_per_sec"] = run["steps_per_sec"]*args.batch_size
+		run["step_time_p50"] = float(np.percentile(step_times, 50))
+		run["step_time_p99"] = float(np.percentile(step_times, 99))
+		runs.append(run)
+
+		print("%s: %.2f steps/sec | %.1f examples/sec | p50 = %.3f s" % (session_args, run["steps_per_sec"], run["examples_per_sec"], run["step_time_p50"]))
+
+	if(len(runs) == 0):
+		print("No configuration finished", file=sys.stderr)
+		sys.exit(1)
+
+	best = max(runs, key=lambda run: run["steps_per_sec"])
+	print("Fastest:", key, best)
+
+	# The file has the best configuration of every nn and input shape, the other entries are kept
+	session_configs = {}
+	if(os.path.exists(args.out)):
+		with open(args.out, "r") as f:
+			session_configs = json.load(f)
+
+	session_configs[key] = best
+	session_configs[key]["batch_size"] = args.batch_size
+	session_configs[key]["runs"] = runs
+
+	print("Writing:", args.out)
+	with open(args.out, "w") as f:
+		f.write(json.dumps(session_configs))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Finds the session configuration (threads, OpenMP environment) with the fastest training steps for a network and an input shape. Every configuration trains for a few steps in its own process. The best configuration is recorded in a JSON file used by train.py, eval.py and predict.py with --session_config', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+	parser.add_argument('--json', type=str, help='JSON file created by tfRecords.py', required=True)
+	parser.add_argument('--nn', type=str, help='Type of neural network', default='u_nn')
+	parser.add_argument('--batch_size', type=int, help='Batch size', default=8)
+	parser.add_argument('--buffer_size', type=int, help='Shuffle buffer size', default=100)
+	parser.add_argument('--learning_rate', type=float, help='Learning rate', default=1e-5)
+	parser.add_argument('--steps', type=int, help='Number of training steps measured for each configuration', default=200)
+	parser.add_argument('--warmup', type=int, help='Number of training steps before measuring', default=20)
+	parser.add_argument('--intra_op_threads', nargs="+", type=int, help='Threads used inside an op, -1 = default', default=[-1, 4, 8, 16])
+	parser.add_argument('--inter_op_threads', nargs="+", type=int, help='Ops run in parallel, -1 = default', default=[1, 2, -1])
+	parser.add_argument('--omp_threads', nargs="+", type=int, help='OMP_NUM_THREADS, -1 = default', default=[-1])
+	parser.add_argument('--kmp_blocktime', nargs="+", type=int, help='KMP_BLOCKTIME in ms, -1 = default', default=[-1])
+	parser.add_argument('--cpu_affinity', type=str, help='Cpus used by every configuration, i.e., 0-15', default=None)
+	parser.add_argument('--kmp_affinity', type=str, help='KMP_AFFINITY used by every configuration', default=None)
+	parser.add_argument('--out', type=str, help='Output JSON file with the best configuration of every nn and input shape', default="session_config.json")
+	parser.add_argument('--worker', type=str, help=argparse.SUPPRESS, default=None)
+
+	args = parser.parse_args()
+
+	main(args)
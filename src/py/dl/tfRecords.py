@@ -9,8 +9,12 @@ import sys
 import json
 import csv
 import uuid
+import hashlib
+import functools
+import multiprocessing
+import collections
 from collections import namedtuple
-import nrrd3D_2D
+from scipy import ndimage
 import tfRecords_split
 
 def _int64_feature(value):
@@ -28,6 +32,670 @@ def _bytes_feature(value):
 		value = [value]
 	return tf.train.Feature(bytes_list=tf.train.BytesList(value=value))
 
+class RecordWriter:
+	# Writes the serialized examples to tfRecord files. By default every example is written to its own file.
+	# If examples_per_shard or shard_size_mb are set, the examples are appended to shard files that are rolled over
+	# when they reach the number of examples or the size limit.
+	# on_open is called with the path of every file before it is created, i.e., ConversionManifest.add_file
+	def __init__(self, out, examples_per_shard=1, shard_size_mb=0, compression=None, on_open=None):
+		self.out = out
+		self.on_open = on_open
+		self.options = None
+		if(compression):
+			self.options = tf.python_io.TFRecordOptions(getattr(tf.python_io.TFRecordCompressionType, compression))
+		self.examples_per_shard = examples_per_shard
+		self.shard_size = int(shard_size_mb*1024*1024)
+		if(self.shard_size > 0 and self.examples_per_shard == 1):
+			# Only the size limit is used
+			self.examples_per_shard = 0
+		self.sharded = examples_per_shard > 1 or self.shard_size > 0
+		self.num_shards = 0
+		self.writer = None
+		self.record_path = None
+		self.index = 0
+		self.offset = 0
+
+	def close(self):
+		if(self.writer):
+			self.writer.close()
+			self.writer = None
+
+	def open(self, record_path):
+		self.close()
+		self.record_path = record_path
+		if(self.on_open):
+			self.on_open(record_path)
+		self.writer = tf.python_io.TFRecordWriter(record_path, options=self.options)
+		self.num_shards += 1
+		self.index = 0
+		self.offset = 0
+
+	def write(self, serialized, record_path=None):
+		# Returns the file, the position of the example in the file and the byte offset of the record
+		# A record is stored as length (8 bytes), crc of length (4 bytes), data and crc of data (4 bytes)
+		# If the records are compressed, the offset is in the uncompressed stream
+		record_size = len(serialized) + 16
+		if(not self.sharded):
+			if(record_path is None):
+				record_path = os.path.join(self.out, str(uuid.uuid4()) + ".tfrecord")
+			self.open(record_path)
+		elif(self.writer is None 
+			or (self.examples_per_shard > 0 and self.index >= self.examples_per_shard) 
+			or (self.shard_size > 0 and self.index > 0 and self.offset + record_size > self.shard_size)):
+			# Shards of a previous conversion are not overwritten
+			while(os.path.exists(os.path.join(self.out, "shard-%05d.tfrecord" % self.num_shards))):
+				self.num_shards += 1
+			self.open(os.path.join(self.out, "shard-%05d.tfrecord" % self.num_shards))
+
+		self.writer.write(serialized)
+		
+		record = (self.record_path, self.index, self.offset)
+		self.index += 1
+		self.offset += record_size
+
+		if(not self.sharded):
+			self.close()
+
+		return record
+
+class ConversionManifest:
+	# Keeps track of the converted rows, the files they were read from and the location of their records.
+	# It is used to convert only the new or modified rows and to resume an interrupted conversion.
+	# The converted rows are appended to <manifest>.journal, save compacts the journal into the manifest.
+	# The record files created by the conversions are also kept, the files that are not in a row are only removed if they were created here
+	def __init__(self, filename, options, rebuild=False):
+		self.filename = filename
+		self.journal_filename = filename + ".journal"
+		self.journal = None
+		self.options = hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()
+		self.rows = {}
+		self.classes = {}
+		self.previous_rows = {}
+		self.files = set()
+
+		if(os.path.exists(filename)):
+			with open(filename, "r") as f:
+				manifest = json.load(f)
+			self.files.update(manifest.get("files", []))
+			if(not rebuild and manifest["options"] == self.options):
+				self.rows = manifest["rows"]
+				self.classes = manifest["classes"]
+				self.read_journal(self.rows)
+			else:
+				print("The conversion options changed, all rows will be converted")
+				self.previous_rows = manifest["rows"]
+				self.read_journal(self.previous_rows)
+			self.files.update(self.record_paths(manifest["rows"]))
+		else:
+			# The journal of a conversion interrupted before the first save
+			self.read_journal({})
+
+	def read_journal(self, rows):
+		# The journal has the rows converted after the last save with the options of the manifest.
+		# The last line is incomplete if the conversion was interrupted while writing it
+		if(os.path.exists(self.journal_filename)):
+			with open(self.journal_filename, "r") as f:
+				for line in f:
+					try:
+						journal_entry = json.loads(line)
+					except ValueError:
+						break
+					if("file" in journal_entry):
+						self.files.add(journal_entry["file"])
+					else:
+						rows[journal_entry["key"]] = journal_entry["entry"]
+						self.files.update(self.record_paths({journal_entry["key"]: journal_entry["entry"]}))
+
+	@staticmethod
+	def row_key(fobj, row_keys):
+		return hashlib.sha1(json.dumps([fobj[key] for key in row_keys]).encode()).hexdigest()
+
+	@staticmethod
+	def row_sources(fobj, row_keys):
+		# Modification time and size of the files in the row
+		sources = {}
+		for key in row_keys:
+			if(os.path.isfile(fobj[key])):
+				stat = os.stat(fobj[key])
+				sources[fobj[key]] = [stat.st_mtime, stat.st_size]
+		return sources
+
+	def is_converted(self, key, sources):
+		return key in self.rows and self.rows[key]["sources"] == sources
+
+	def record_paths(self, rows=None):
+		if(rows is None):
+			rows = self.rows
+		return set([record["tfRecord"] for entry in rows.values() for record in entry["records"]])
+
+	def write_journal(self, journal_entry):
+		if(self.journal is None):
+			self.journal = open(self.journal_filename, "a")
+		self.journal.write(json.dumps(journal_entry) + "\n")
+
+	def add(self, key, entry):
+		# Appends a converted row to the journal, the manifest file is not rewritten
+		self.rows[key] = entry
+		self.write_journal({"key": key, "entry": entry})
+
+	def add_file(self, path):
+		# A record file is created by the conversion. It is in the journal before the file exists
+		self.files.add(path)
+		self.write_journal({"file": path})
+		self.flush()
+
+	def flush(self):
+		if(self.journal):
+			self.journal.flush()
+
+	def save(self):
+		# The manifest is written to a temporary file and renamed, an interrupted conversion never leaves a partial manifest.
+		# The journal is removed after the rename, replaying it again on the saved manifest gives the same rows
+		manifest = {}
+		manifest["options"] = self.options
+		manifest["classes"] = self.classes
+		manifest["rows"] = self.rows
+		manifest["files"] = sorted([tfr for tfr in self.files if os.path.exists(tfr)])
+		with open(self.filename + ".tmp", "w") as f:
+			f.write(json.dumps(manifest))
+		os.replace(self.filename + ".tmp", self.filename)
+
+		if(self.journal):
+			self.journal.close()
+			self.journal = None
+		if(os.path.exists(self.journal_filename)):
+			os.remove(self.journal_filename)
+
+# Number of bits set in every byte value, the hamming distance of two hashes is the popcount of their xor
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+class PerceptualHashIndex:
+	# Perceptual hashes of the rows kept in the dataset. It is saved next to the manifest and used to find near duplicates.
+	# The 64 bits are split in distance + 1 chunks and every chunk value has a bucket with the rows. Two hashes within
+	# the distance have at least one equal chunk, find only compares the hashes in the buckets of the query (multi-index hashing)
+	def __init__(self, filename, distance=4):
+		self.filename = filename
+		self.distance = distance
+		self.row_ids = []
+		self.row_id_set = set()
+		self.rows = []
+		# The packed hashes, the array doubles its size when it is full
+		self.hashes = np.zeros([1024], dtype=np.uint64)
+		self.size = 0
+		bounds = np.linspace(0, 64, min(distance + 1, 64) + 1).astype(int)
+		self.chunks = list(zip(bounds[:-1], bounds[1:]))
+		self.buckets = [{} for chunk in self.chunks]
+		self.saved = {}
+		if(os.path.exists(filename)):
+			with open(filename, "r") as f:
+				self.saved = json.load(f)
+
+	def chunk_values(self, phash):
+		return [(phash >> int(start)) & ((1 << int(end - start)) - 1) for start, end in self.chunks]
+
+	def add(self, row_id, phash, row):
+		phash = int(phash, 16)
+		if(self.size == self.hashes.shape[0]):
+			self.hashes = np.concatenate([self.hashes, np.zeros_like(self.hashes)])
+		self.hashes[self.size] = phash
+		for bucket, value in zip(self.buckets, self.chunk_values(phash)):
+			if(not value in bucket):
+				bucket[value] = []
+			bucket[value].append(self.size)
+		self.size += 1
+		self.row_ids.append(row_id)
+		self.row_id_set.add(row_id)
+		self.rows.append(row)
+
+	def find(self, phash):
+		# Returns the row with the smallest hamming distance if it is within the distance
+		phash = int(phash, 16)
+		candidates = set()
+		for bucket, value in zip(self.buckets, self.chunk_values(phash)):
+			candidates.update(bucket.get(value, []))
+		if(len(candidates) == 0):
+			return None
+		candidates = np.array(sorted(candidates))
+		xor = np.bitwise_xor(self.hashes[candidates], np.uint64(phash))
+		hamming = POPCOUNT[xor.view(np.uint8)].reshape([-1, 8]).sum(axis=1)
+		closest = np.argmin(hamming)
+		if(hamming[closest] <= self.distance):
+			return self.rows[candidates[closest]]
+		return None
+
+	def save(self):
+		index = {}
+		for row_id, row, phash in zip(self.row_ids, self.rows, self.hashes[0:self.size]):
+			index[row_id] = {"hash": "%016x" % int(phash), "row": row}
+		with open(self.filename, "w") as f:
+			f.write(json.dumps(index))
+
+def raw_dtype(dtype):
+	# Returns the dtype used to store the pixel buffer as raw bytes. The dtype must be supported by tf.decode_raw
+	dtype = np.dtype(dtype)
+	if(dtype == np.bool_):
+		return np.dtype(np.uint8)
+	if(dtype == np.float64):
+		return np.dtype(np.float32)
+	if(dtype == np.uint32 or dtype == np.uint64):
+		return np.dtype(np.int64)
+	# tf.decode_raw reads little endian buffers
+	return dtype.newbyteorder('<')
+
+def resize_image(img_np, resize_shape, mode="pad", offset_seed=None, order=1):
+	# Resizes the spatial dimensions of the image, i.e., the first len(resize_shape) dimensions. The pixel components are not modified.
+	# 'pad' places the image in a zero image at an offset, the image must not be larger than resize_shape.
+	# 'crop' pads or crops every dimension at an offset.
+	# 'resample' interpolates the image to resize_shape, order is the order of the spline interpolation (0 for label maps).
+	# offset_seed has a value in [0, 1) per dimension that is scaled by the size difference, None places the image at the origin
+	resize_shape = list(resize_shape)
+	spatial_shape = list(img_np.shape[0:len(resize_shape)])
+	components_shape = list(img_np.shape[len(resize_shape):])
+
+	if(spatial_shape == resize_shape):
+		return img_np
+
+	if(mode == "resample"):
+		zoom = [float(r)/s for r, s in zip(resize_shape, spatial_shape)] + [1]*len(components_shape)
+		img_np = ndimage.zoom(img_np, zoom, order=order)
+		# The output shape of zoom is rounded, make sure it matches
+		return resize_image(img_np, resize_shape, mode="crop")
+
+	delta_shape = np.array(resize_shape) - np.array(spatial_shape)
+	if(mode == "pad" and np.any(delta_shape < 0)):
+		raise Exception("The resize shape " + str(resize_shape) + " is smaller than the image shape " + str(spatial_shape) + ", use --resize_mode crop or resample")
+
+	if(offset_seed is None):
+		offset_seed = np.zeros(len(resize_shape))
+	offset = (np.array(offset_seed)*np.abs(delta_shape)).astype(int)
+
+	img_slice = []
+	resize_slice = []
+	for d, o, s, r in zip(delta_shape, offset, spatial_shape, resize_shape):
+		if(d >= 0):
+			img_slice.append(slice(0, s))
+			resize_slice.append(slice(o, o + s))
+		else:
+			img_slice.append(slice(o, o + r))
+			resize_slice.append(slice(0, r))
+
+	img_np_x = np.zeros(resize_shape + components_shape, dtype=img_np.dtype)
+	img_np_x[tuple(resize_slice)] = img_np[tuple(img_slice)]
+
+	return img_np_x
+
+def image_stats(img_np, num_channels, histogram_bins=64):
+	# Single pass statistics of an image per channel. The statistics of several images are combined with merge_stats.
+	# The histogram bins have a power of 2 width and are aligned to multiples of the width, histograms with different
+	# widths are merged exactly by combining bins
+	img_np = np.reshape(img_np, [-1, num_channels]).astype(np.float64)
+
+	stats = {}
+	stats["count"] = int(img_np.shape[0])
+	mean = np.mean(img_np, axis=0)
+	stats["mean"] = mean.tolist()
+	stats["m2"] = np.sum(np.square(img_np - mean), axis=0).tolist()
+
+	img_min = np.min(img_np)
+	img_max = np.max(img_np)
+	width = 2.0**max(np.ceil(np.log2(max(img_max - img_min, 1e-12)/histogram_bins)), -16)
+	while(np.floor(img_max/width) - np.floor(img_min/width) + 1 > histogram_bins):
+		width *= 2
+
+	start = int(np.floor(img_min/width))
+	bins = np.floor(img_np/width).astype(np.int64) - start
+	num_bins = int(np.max(bins)) + 1
+
+	histogram = {}
+	histogram["width"] = width
+	histogram["start"] = start
+	histogram["counts"] = [np.bincount(bins[:,c], minlength=num_bins).tolist() for c in range(num_channels)]
+	stats["histogram"] = histogram
+
+	return stats
+
+def rebin_histogram(histogram, width):
+	# Combines the bins of the histogram to a larger width, returns the first bin and the counts for the new width
+	factor = int(round(width/histogram["width"]))
+	counts = np.array(histogram["counts"])
+	bins = (histogram["start"] + np.arange(counts.shape[1]))//factor
+	start = int(bins[0])
+	rebinned = np.zeros([counts.shape[0], int(bins[-1]) - start + 1], dtype=np.int64)
+	for c in range(counts.shape[0]):
+		np.add.at(rebinned[c], bins - start, counts[c])
+	return start, rebinned
+
+def merge_stats(stats, other_stats, histogram_bins=64):
+	# Merges the statistics of two sets of images. The mean and variance are combined with Chan's parallel algorithm
+	merged = {}
+	count = stats["count"] + other_stats["count"]
+	mean = np.array(stats["mean"])
+	other_mean = np.array(other_stats["mean"])
+	delta = other_mean - mean
+
+	merged["count"] = count
+	merged["mean"] = (mean + delta*other_stats["count"]/count).tolist()
+	merged["m2"] = (np.array(stats["m2"]) + np.array(other_stats["m2"]) + np.square(delta)*stats["count"]*other_stats["count"]/count).tolist()
+
+	histogram = stats["histogram"]
+	other_histogram = other_stats["histogram"]
+	width = max(histogram["width"], other_histogram["width"])
+
+	while(True):
+		start, counts = rebin_histogram(histogram, width)
+		other_start, other_counts = rebin_histogram(other_histogram, width)
+		merged_start = min(start, other_start)
+		num_bins = max(start + counts.shape[1], other_start + other_counts.shape[1]) - merged_start
+		if(num_bins <= histogram_bins):
+			break
+		width *= 2
+
+	merged_counts = np.zeros([counts.shape[0], num_bins], dtype=np.int64)
+	merged_counts[:, start - merged_start:start - merged_start + counts.shape[1]] += counts
+	merged_counts[:, other_start - merged_start:other_start - merged_start + other_counts.shape[1]] += other_counts
+
+	merged["histogram"] = {}
+	merged["histogram"]["width"] = width
+	merged["histogram"]["start"] = merged_start
+	merged["histogram"]["counts"] = merged_counts.tolist()
+
+	return merged
+
+def finalize_stats(stats, percentiles=[0.5, 1, 5, 25, 50, 75, 95, 99, 99.5]):
+	# Computes the mean, variance, standard deviation and approximated percentiles per channel
+	description = {}
+	description["mean"] = stats["mean"]
+	variance = np.array(stats["m2"])/max(stats["count"] - 1, 1)
+	description["variance"] = variance.tolist()
+	description["std"] = np.sqrt(variance).tolist()
+	description["histogram"] = stats["histogram"]
+
+	histogram = stats["histogram"]
+	counts = np.array(histogram["counts"], dtype=np.float64)
+	edges = (histogram["start"] + np.arange(counts.shape[1] + 1))*histogram["width"]
+	description["percentiles"] = {}
+	for p in percentiles:
+		values = []
+		for channel_counts in counts:
+			cumulative = np.concatenate([[0], np.cumsum(channel_counts)])/np.sum(channel_counts)
+			# Linear interpolation inside the bin
+			values.append(float(np.interp(p/100.0, cumulative, edges)))
+		description["percentiles"][str(p)] = values
+
+	return description
+
+def perceptual_hash(img_np, num_channels):
+	# 64 bit difference hash. The image is averaged in a 8x9 grid and every bit compares two neighbor cells
+	img_np = np.array(img_np, dtype=np.float64)
+	if(num_channels > 1):
+		img_np = np.mean(img_np, axis=-1)
+	while(img_np.ndim > 2):
+		# For 3D images the hash is computed in the middle slice
+		img_np = img_np[img_np.shape[0]//2]
+	grid = np.array([[np.mean(cell) for cell in np.array_split(row, 9, axis=1)] for row in np.array_split(img_np, 8, axis=0)])
+	bits = (grid[:, 1:] > grid[:, :-1]).reshape(-1)
+	return "%016x" % int("".join(["1" if b else "0" for b in bits]), 2)
+
+def read_image(filename):
+	img_read = itk.ImageFileReader.New(FileName=filename)
+	img_read.Update()
+	return img_read.GetOutput()
+
+def slice_volumes(images):
+	# Slices the 3D images of a row in memory along the 3 major axes. As in nrrd3D_2D, the slices are placed at the origin
+	# of a square image with the size of the largest dimension of the first image. Yields the images and the slice features
+	volumes = list(images.values())
+	if(len(volumes) == 0):
+		raise Exception("There are no images to slice in the row")
+	first_np, first_components = volumes[0]
+	if(first_np.ndim - (first_components > 1) != 3):
+		raise Exception("--slice needs 3D images")
+
+	slice_size = [max(first_np.shape[0:3])]*2
+	for dim in range(3):
+		for sln in range(first_np.shape[dim]):
+			slice_images = {}
+			for key, (img_np, num_components) in images.items():
+				slice_images[key] = (resize_image(np.take(img_np, sln, axis=dim), slice_size, mode="pad"), num_components)
+			yield slice_images, {"slice_axis": dim, "slice_index": sln}
+
+def example_features(fobj, row_keys, images, fields={}, enumerate_key=None, enumerate_class={}, encoding="float", histogram_bins=64, variable_shape=False):
+	# Builds the features of an example and their description. images has the image arrays of the row.
+	# If variable_shape is set, the shape of every image is stored in the <key>_shape feature
+	feature = {}
+	description = {}
+
+	for key in row_keys:
+
+		description[key] = {}
+
+		if(key in images):
+			img_np, num_components = images[key]
+
+			if(encoding == "raw"):
+				# The pixel buffer is stored as bytes, it is decoded with tf.decode_raw and cast to float in the graph
+				feature[key] = _bytes_feature(img_np.tobytes())
+				description[key]["encoding"] = "raw"
+				description[key]["dtype"] = "tf." + img_np.dtype.name
+			else:
+				feature[key] =  _float_feature(img_np.reshape(-1).tolist())
+
+			# Put the shape of the image in the json object if it does not exists. This is done for global information
+			img_shape = list(img_np.shape)
+			if(img_shape[0] == 1):
+				# If the first component is 1 we remove it. It means that is a 2D image but was saved as 3D
+				img_shape = img_shape[1:]
+
+			# This is the number of channels, if the number of components is 1, it is not included in the image shape
+			# If it has more than one component, it is included in the shape, that's why we have to add the 1
+			if(num_components == 1):
+				img_shape = img_shape + [1]
+
+			description[key]["shape"] = img_shape
+			if(variable_shape):
+				feature[key + "_shape"] = _int64_feature(img_shape)
+				description[key]["variable_shape"] = True
+			description[key]["max"] = float(np.max(img_np))
+			description[key]["min"] = float(np.min(img_np))
+			description[key]["stats"] = image_stats(img_np, img_shape[-1], histogram_bins)
+			description[key]["type"] = "tf.float32"
+			
+		elif(enumerate_key and key == enumerate_key):
+			# If its an enumeration, it will save the class enumeration as int. If is a label map, it never reached this step
+			# because it was read as an image. 
+			class_name = fobj[key]
+			class_number = int(enumerate_class[class_name])
+
+			feature[key] = _int64_feature(class_number)
+
+			description[key]["shape"] = [1]
+			description[key]["type"] = "tf.int64"
+
+		else:
+			try:
+				# If the previous failed, try converting it to float
+				feature[key] = _float_feature(np.array([float(fobj[key])]).tolist())
+
+				description[key]["shape"] = [1]
+				description[key]["type"] = "tf.float32"
+			except:
+				# If it fails the try saving it as a bytes feature
+				# encode the string
+				feature[key] = _bytes_feature(fobj[key].encode())
+
+				description[key]["shape"] = [1]
+				description[key]["type"] = "tf.string"
+
+	for field in fields:
+		# Integer features of the example that are not in the csv, i.e., slice axis and index
+		feature[field] = _int64_feature(int(fields[field]))
+		description[field] = {}
+		description[field]["shape"] = [1]
+		description[field]["type"] = "tf.int64"
+
+	return feature, description
+
+def row_examples(fobj, row_keys, images, slice_images=False, enumerate_key=None, enumerate_class={}, encoding="float", histogram_bins=64, variable_shape=False):
+	# Yields the serialized examples of a row, their fields and their description. One example or one per slice if slice_images is set.
+	# The slices are generated one at a time, a volume is never held in memory as serialized slices
+	if(slice_images):
+		# The slices are not written as images, every slice is an example
+		examples_images = slice_volumes(images)
+	else:
+		examples_images = [(images, {})]
+
+	for example_images, fields in examples_images:
+		feature, example_description = example_features(fobj, row_keys, example_images, fields, enumerate_key=enumerate_key, enumerate_class=enumerate_class, encoding=encoding, histogram_bins=histogram_bins, variable_shape=variable_shape)
+		example = tf.train.Example(features=tf.train.Features(feature=feature))
+		yield example.SerializeToString(), fields, example_description
+
+def convert_row(row, row_keys=[], enumerate_key=None, enumerate_class={}, resize=None, resize_mode="pad", encoding="float", histogram_bins=64, dedup_key=None, slice_images=False, variable_shape=False, label_keys=[], stream=False):
+	# Converts a single csv row to serialized tf.train.Examples, see row_examples.
+	# This function runs in the worker processes, it does not modify the global description. Instead, it returns
+	# the description of the keys computed on the images of the row (label values and perceptual hash) and the examples
+	# with their description, which are merged by the parent process.
+	# If stream is set, i.e., the row is converted in the parent process, the examples are a generator and they are
+	# built while they are written. Otherwise they are a list sent back to the parent process
+	row_index, fobj = row
+	images = {}
+	description = {}
+	# This seed is only used when images of different sizes are used. It depends only on the row index so the output
+	# is the same regardless of the number of workers
+	offset_seed = None
+
+	try:
+
+		for key in row_keys:
+
+			description[key] = {}
+
+			##If the path exists then it will try to read it as an image
+			if(os.path.exists(fobj[key])):
+				img = read_image(fobj[key])
+				
+				if(encoding == "raw"):
+					# Keep the native type of the pixel buffer
+					img_np = itk.GetArrayViewFromImage(img).astype(raw_dtype(itk.GetArrayViewFromImage(img).dtype))
+				else:
+					img_np = itk.GetArrayViewFromImage(img).astype(float)
+
+				if(enumerate_key and key == enumerate_key):
+					# Label values in the label map, computed on the image in memory before any resize
+					description[key]["labels"] = np.unique(itk.GetArrayViewFromImage(img)).tolist()
+
+				if(dedup_key and key == dedup_key):
+					description[key]["phash"] = perceptual_hash(itk.GetArrayViewFromImage(img), img.GetNumberOfComponentsPerPixel())
+				if(resize):
+					if(offset_seed is None):
+						# We have to use the same offset in the case we are storing multiple images, i.e., per input row
+						offset_seed = np.random.RandomState(row_index).rand(len(resize))
+					# Label maps are resampled with nearest neighbor interpolation
+					img_np = resize_image(img_np, resize, mode=resize_mode, offset_seed=offset_seed, order=0 if key in label_keys else 1)
+
+				images[key] = (img_np, img.GetNumberOfComponentsPerPixel())
+
+		examples = row_examples(fobj, row_keys, images, slice_images=slice_images, enumerate_key=enumerate_key, enumerate_class=enumerate_class, encoding=encoding, histogram_bins=histogram_bins, variable_shape=variable_shape)
+		if(not stream):
+			examples = list(examples)
+
+		return examples, description, None
+
+	except Exception as e:
+		return None, None, e
+
+def imap_bounded(pool, func, rows, max_pending):
+	# Same as pool.imap but at most max_pending rows are converted and not written yet. The examples of the
+	# sliced volumes are sent back in memory, the workers wait instead of queueing the slices of every volume
+	pending = collections.deque()
+	for row in rows:
+		pending.append(pool.apply_async(func, (row,)))
+		if(len(pending) >= max_pending):
+			yield pending.popleft().get()
+	while(len(pending) > 0):
+		yield pending.popleft().get()
+
+def check_description(obj, description, fobj):
+	# Raises if the images of a row do not match the global description, it is called before the records of the row are written
+	for key in description:
+		if(description[key].get("variable_shape")):
+			# Images of different sizes are allowed, the number of dimensions and channels must be the same
+			if(key in obj and "shape" in obj[key] and (len(obj[key]["shape"]) != len(description[key]["shape"]) or obj[key]["shape"][-1] != description[key]["shape"][-1])):
+				print(fobj[key], file=sys.stderr)
+				raise Exception("The images in your training set do not have the same number of dimensions or channels!")
+		elif(key in obj and "shape" in obj[key] and not np.all(np.equal(obj[key]["shape"], description[key]["shape"]))):
+			print(fobj[key], file=sys.stderr)
+			raise Exception("The images in your training set do not have the same dimensions!")
+		if(key in obj and "dtype" in obj[key] and obj[key]["dtype"] != description[key].get("dtype")):
+			# The column is not an image in this row or it has another pixel type
+			print(fobj[key], file=sys.stderr)
+			raise Exception("The images in your training set do not have the same pixel type! " + obj[key]["dtype"] + " " + str(description[key].get("dtype")))
+
+def merge_description(obj, description, fobj, histogram_bins=64):
+	# Merges the description of a converted row into the global description. The shapes are checked first
+	# so a row that fails does not modify the global description
+	check_description(obj, description, fobj)
+
+	for key in description:
+
+		if(not key in obj):
+			obj[key] = {}
+
+		if(not "shape" in obj[key]):
+			if("max" in description[key]):
+				print("Shape", key, description[key]["shape"])
+			obj[key]["shape"] = description[key]["shape"]
+
+		if(description[key].get("variable_shape")):
+			# The dimensions that change between images are -1 in the shape. The bounds are used to bucket the images
+			obj[key]["variable_shape"] = True
+			obj[key]["min_shape"] = np.minimum(obj[key].get("min_shape", description[key]["shape"]), description[key].get("min_shape", description[key]["shape"])).tolist()
+			obj[key]["max_shape"] = np.maximum(obj[key].get("max_shape", description[key]["shape"]), description[key].get("max_shape", description[key]["shape"])).tolist()
+			obj[key]["shape"] = np.where(np.equal(obj[key]["min_shape"], obj[key]["max_shape"]), obj[key]["max_shape"], -1).tolist()
+
+		if("max" in description[key]):
+			if(not "max" in obj[key]):
+				obj[key]["max"] = description[key]["max"]
+			else:
+				obj[key]["max"] = max(obj[key]["max"], description[key]["max"])
+
+		if("min" in description[key]):
+			if(not "min" in obj[key]):
+				obj[key]["min"] = description[key]["min"]
+			else:
+				obj[key]["min"] = min(obj[key]["min"], description[key]["min"])
+
+		if("stats" in description[key]):
+			if(not "stats" in obj[key]):
+				obj[key]["stats"] = description[key]["stats"]
+			else:
+				obj[key]["stats"] = merge_stats(obj[key]["stats"], description[key]["stats"], histogram_bins)
+
+		if(not "type" in obj[key]):
+			obj[key]["type"] = description[key]["type"]
+
+		if("encoding" in description[key] and not "encoding" in obj[key]):
+			obj[key]["encoding"] = description[key]["encoding"]
+			obj[key]["dtype"] = description[key]["dtype"]
+
+def write_class_manifest(filename, class_records, file_records, sharded):
+	# One line per class and file, class<TAB>path or class<TAB>path<TAB>num_records<TAB>index,index... for sharded records.
+	# The paths are relative to the directory of the JSON description
+	json_dir = os.path.dirname(filename)
+	print("Writing:", filename)
+	with open(filename, "w") as f:
+		for class_number in sorted(class_records):
+			files = {}
+			for record in class_records[class_number]:
+				if(not record["tfRecord"] in files):
+					files[record["tfRecord"]] = []
+				files[record["tfRecord"]].append(record["index"])
+			for tfr in sorted(files):
+				line = [str(class_number), os.path.relpath(tfr, json_dir if json_dir else os.curdir)]
+				if(sharded):
+					line += [str(file_records[tfr]), ",".join([str(index) for index in sorted(files[tfr])])]
+				f.write("\t".join(line) + "\n")
+	return os.path.basename(filename)
+
 def main(args):
 	
 
@@ -45,222 +713,356 @@ def main(args):
 		csv_reader = csv.DictReader(csvfile)
 		row_keys = csv_reader.fieldnames.copy()
 
-		if("tfRecord" in row_keys):
-			row_keys.remove("tfRecord")
+		for record_key in ["tfRecord", "tfRecord_index", "tfRecord_offset", "duplicate_of", "slice_axis", "slice_index"]:
+			if(record_key in row_keys):
+				row_keys.remove(record_key)
 		if(not "data_keys" in obj):
 			obj["data_keys"] = row_keys
 
 		for row in csv_reader:
-			# If we need to slice the images, save 2D slices with the same dimensions
-			if args.slice:
-
-				obj["slice"] = True
-
-				slice_imgs = []
-				slice_csv_headers = []
-
-				# We check if the path exists, then we read it as an image
-				for key in row_keys:
-					if os.path.exists(row[key]):
-						if not key in slice_csv_headers:
-							slice_csv_headers.append(key)
-						slice_imgs.append(row[key])
-
-				# We generate an object with the corresponding parameters
-				slice_obj = {}
-				slice_obj["img"] = slice_imgs
-				slice_obj["out_csv_headers"] = slice_csv_headers
-				slice_obj["out_csv"] = os.path.join(args.out, "slice.csv")
-				slice_obj["out"] = os.path.join(args.out, "slice")
-
-				# We convert the dictionary to a namedtuple, a.k.a, python object, i.e., argparse object
-				slice_args = namedtuple("Slice", slice_obj.keys())(*slice_obj.values())
-				# Call the main of the script
-				nrrd3D_2D.main(slice_args)
-				
-				# We read the saved data and append the properties of the 3D image to all slices
-				with open(slice_obj["out_csv"]) as csvfileslice:
-					csv_slice_reader = csv.DictReader(csvfileslice)
-					for slice_row in csv_slice_reader:
-						for rk in row_keys:
-							if(not rk in csv_slice_reader.fieldnames):
-								slice_row[rk] = row[rk]
-						# We now have a csv_rows list with slices instead of 3D volumes
-						csv_rows.append(slice_row)
-			else:
-				csv_rows.append(row)
+			csv_rows.append(row)
+
+	if(args.slice):
+		# The 3D images are sliced in memory along the major axes while they are converted, every slice is a record.
+		# The axis and the index of the slice are stored as features
+		obj["slice"] = True
+		obj["data_keys"] = row_keys + ["slice_axis", "slice_index"]
 
 	if(not os.path.exists(args.out) or not os.path.isdir(args.out)):
 		os.makedirs(args.out)
 
+	conversion_options = {}
+	conversion_options["data_keys"] = row_keys
+	for option in ["enumerate", "slice", "resize", "resize_mode", "encoding", "compression", "examples_per_shard", "shard_size_mb", "histogram_bins", "dedup", "dedup_distance", "dedup_action", "variable_shape", "label_keys"]:
+		conversion_options[option] = getattr(args, option)
+
+	# Image columns with label maps, i.e., the segmentation targets of u_nn. They are resampled and augmented with nearest neighbor
+	label_keys = list(args.label_keys) if args.label_keys else []
+	if(args.enumerate and not args.enumerate in label_keys):
+		label_keys.append(args.enumerate)
+	if(len(label_keys) > 0):
+		obj["label_keys"] = label_keys
+
+	manifest = ConversionManifest(args.out.rstrip(os.sep) + "_manifest.json", conversion_options, rebuild=args.rebuild)
+
 	if(args.enumerate):
 		obj["enumerate"] = args.enumerate
 		obj[args.enumerate] = {}
-		obj[args.enumerate]["class"] = {}
+		# The classes of a previous conversion keep their number
+		obj[args.enumerate]["class"] = dict(manifest.classes)
 		#This is the number of classes
-		num_class = 0
+		num_class = len(manifest.classes)
 		print("Enumerate classes...")
+		# The class names are enumerated in the order they appear in the csv. If the column is a label map, the
+		# label values are collected while the images are converted, the class table is completed after the conversion
 		for fobj in csv_rows:
 			class_name = fobj[args.enumerate]
-			if os.path.exists(class_name):
-				#Count number of labels in image
-				img_label_read = itk.ImageFileReader.New(FileName=class_name)
-				img_label_read.Update()
-				img_label = img_label_read.GetOutput()
-
-				label_stats = itk.LabelStatisticsImageFilter[type(img_label),type(img_label)].New()
-				label_stats.SetInput(img_label)
-				label_stats.SetLabelInput(img_label)
-				label_stats.Update()
-				
-				for class_label in label_stats.GetValidLabelValues():
-					if(not class_label in obj[args.enumerate]["class"]):
-						obj[args.enumerate]["class"][class_label] = num_class
-						num_class += 1
-
-			elif(not class_name in obj[args.enumerate]["class"]):
+			if(not os.path.exists(class_name) and not class_name in obj[args.enumerate]["class"]):
 				obj[args.enumerate]["class"][class_name] = num_class
 				num_class += 1
-		#Put the total of elements for convenience
-		obj[args.enumerate]["num_class"] = num_class
+		manifest.classes = dict(obj[args.enumerate]["class"])
 
-		print(obj[args.enumerate])
+	if(args.resize):
+		obj["resize"] = args.resize
+		obj["resize_mode"] = args.resize_mode
 
-	for fobj in csv_rows:
-		
-		feature = {}
-		# This seed is only used when images of different sizes are used
-		random_delta_seed = None
+	if(args.compression):
+		obj["compression"] = args.compression
 
-		try:
+	if(args.variable_shape):
+		obj["variable_shape"] = True
 
-			for key in row_keys:
+	record_writer = RecordWriter(args.out, examples_per_shard=args.examples_per_shard, shard_size_mb=args.shard_size_mb, compression=args.compression, on_open=manifest.add_file)
 
-				if(not key in obj):
-					obj[key] = {}
+	# Find the rows that are up to date. The records of modified or removed rows are stale, the files that contain them
+	# are deleted. In sharded mode, the records of up to date rows that share a shard with a stale record are copied first
+	row_ids = [ConversionManifest.row_key(fobj, row_keys) for fobj in csv_rows]
+	rows_sources = [ConversionManifest.row_sources(fobj, row_keys) for fobj in csv_rows]
 
-				##If the path exists then it will try to read it as an image
-				if(os.path.exists(fobj[key])):
-					img_read = itk.ImageFileReader.New(FileName=fobj[key])
-					img_read.Update()
-					img = img_read.GetOutput()
-					
-					img_np = itk.GetArrayViewFromImage(img).astype(float)
-					if(args.resize):
-						obj["resize"] = args.resize
-						
-						resize_shape = list(args.resize)
-						if(img.GetNumberOfComponentsPerPixel() > 1):
-							resize_shape += [img.GetNumberOfComponentsPerPixel()]
-						img_np_x =  np.zeros(resize_shape)
-
-						img_np_assign_shape = []
-						# Compute the difference between the shapes
-						delta_shape = np.array(resize_shape) - np.array(img_np.shape)
-						if(not random_delta_seed):
-							# We have to use the same seed in the case we are storing multiple images, i.e., per input row
-							random_delta_seed = np.random.rand(delta_shape.size)
-						random_delta = (random_delta_seed*delta_shape).astype(int)
-
-						# We create the assign operation using the random_delta. We don't want the network to be specific to 
-						# the image position
-						for s, r in zip(img_np.shape, random_delta):
-							img_np_assign_shape.append(str(r) + ":" + str(s+r))
-
-						assign_img = "img_np_x[" + ",".join(img_np_assign_shape) + "] = img_np"
-
-						exec(assign_img)
-						img_np = img_np_x
-
-					feature[key] =  _float_feature(img_np.reshape(-1).tolist())
-
-					# Put the shape of the image in the json object if it does not exists. This is done for global information
-					img_shape = list(img_np.shape)
-					if(img_shape[0] == 1):
-						# If the first component is 1 we remove it. It means that is a 2D image but was saved as 3D
-						img_shape = img_shape[1:]
-
-					# This is the number of channels, if the number of components is 1, it is not included in the image shape
-					# If it has more than one component, it is included in the shape, that's why we have to add the 1
-					if(img.GetNumberOfComponentsPerPixel() == 1):
-						img_shape = img_shape + [1]
-
-					if(not "shape" in obj[key]):
-						print("Shape", key, img_shape)
-						obj[key]["shape"] = img_shape
-					else:
-						if not np.all(np.equal(obj[key]["shape"] , img_shape)):
-							print(fobj[key], file=sys.stderr)
-							raise "The images in your training set do not have the same dimensions!"
+	converted_rows = {}
+	for fobj, row_id, sources in zip(csv_rows, row_ids, rows_sources):
+		if(manifest.is_converted(row_id, sources)):
+			try:
+				merge_description(obj, manifest.rows[row_id]["description"], fobj, args.histogram_bins)
+				converted_rows[row_id] = manifest.rows[row_id]
+			except Exception as e:
+				print("Error converting to tfRecord", fobj, e, file=sys.stderr)
 
-					if(not "max" in obj[key]):
-						obj[key]["max"] = np.max(img_np)
-					else:
-						obj[key]["max"] = max(obj[key]["max"], np.max(img_np))
+	stale_paths = (manifest.record_paths() | manifest.record_paths(manifest.previous_rows)) - manifest.record_paths(converted_rows)
 
-					if(not "min" in obj[key]):
-						obj[key]["min"] = np.min(img_np)
-					else:
-						obj[key]["min"] = min(obj[key]["min"], np.min(img_np))
+	# Records written by an interrupted conversion are not in a row of the manifest, i.e., a shard that was not complete.
+	# They are removed so they are not read as duplicates and the shard names are reused. Only the files created by
+	# a conversion with this manifest are removed, other records in the output directory are kept unless --rebuild is set
+	record_paths = set([os.path.normpath(tfr) for tfr in manifest.record_paths() | stale_paths])
+	created_paths = set([os.path.normpath(tfr) for tfr in manifest.files])
+	for tfr in glob.iglob(os.path.join(args.out, '**/*.tfrecord'), recursive=True):
+		if(os.path.normpath(tfr) in record_paths):
+			continue
+		if(os.path.normpath(tfr) in created_paths or args.rebuild):
+			print("Removing record not in manifest", tfr)
+			os.remove(tfr)
+		else:
+			print("Keeping record not created by this conversion, it is read with the converted records. Use --rebuild to remove it", tfr, file=sys.stderr)
 
-					if(not "type" in obj[key]):
-						obj[key]["type"] = "tf.float32"
-					
-				elif(args.enumerate and key == args.enumerate):
-					# If its an enumeration, it will save the class enumeration as int. If is a label map, it never reached this step
-					# because it was read as an image. 
-					class_name = fobj[key]
-					class_number = int(obj[args.enumerate]["class"][class_name])
+	print(len(converted_rows), "rows are up to date,", len(csv_rows) - len(converted_rows), "rows will be converted")
 
-					feature[key] = _int64_feature(class_number)
+	if(len(stale_paths) > 0):
+		options = record_writer.options
+		for tfr in sorted(stale_paths):
+			if(not os.path.exists(tfr)):
+				continue
+			copy_records = {}
+			for row_id, entry in converted_rows.items():
+				for record in entry["records"]:
+					if(record["tfRecord"] == tfr):
+						copy_records[record["index"]] = record
+			if(len(copy_records) > 0):
+				print("Copying", len(copy_records), "records from", tfr)
+				for record_index, serialized in enumerate(tf.python_io.tf_record_iterator(tfr, options=options)):
+					if(record_index in copy_records):
+						record = copy_records[record_index]
+						record["tfRecord"], record["index"], record["offset"] = record_writer.write(serialized)
 
-					if(not "shape" in obj[key]):
-						obj[key]["shape"] = [1]
+		record_writer.close()
+		manifest.rows = dict(converted_rows)
+		manifest.save()
 
-					if(not "type" in obj[key]):
-						obj[key]["type"] = "tf.int64"
+		for tfr in stale_paths:
+			if(os.path.exists(tfr)):
+				print("Removing stale record", tfr)
+				os.remove(tfr)
+	else:
+		manifest.rows = dict(converted_rows)
+		# The manifest exists before any row is converted, the records of an interrupted conversion are always found
+		manifest.save()
 
+	convert = functools.partial(convert_row, 
+		row_keys=row_keys, 
+		enumerate_key=args.enumerate, 
+		enumerate_class=obj[args.enumerate]["class"] if args.enumerate else {}, 
+		resize=args.resize,
+		resize_mode=args.resize_mode,
+		encoding=args.encoding,
+		histogram_bins=args.histogram_bins,
+		dedup_key=args.dedup,
+		slice_images=args.slice,
+		variable_shape=args.variable_shape,
+		label_keys=label_keys,
+		stream=args.workers <= 1)
+
+	if(args.dedup):
+		# The hashes of the rows that are up to date are kept, the hashes of removed or modified rows are dropped
+		dedup_index = PerceptualHashIndex(args.out.rstrip(os.sep) + "_phash.json", args.dedup_distance)
+		for fobj, row_id in zip(csv_rows, row_ids):
+			if(row_id in manifest.rows and not "duplicate_of" in manifest.rows[row_id] and not row_id in dedup_index.row_id_set):
+				if(row_id in dedup_index.saved):
+					dedup_index.add(row_id, dedup_index.saved[row_id]["hash"], dedup_index.saved[row_id]["row"])
 				else:
-					try:
-						# If the previous failed, try converting it to float
-						feature[key] = _float_feature(np.array([float(fobj[key])]).tolist())
+					dedup_index.add(row_id, manifest.rows[row_id]["description"][args.dedup]["phash"], fobj[args.dedup])
 
-						if(not "shape" in obj[key]):
-							obj[key]["shape"] = [1]
+	convert_rows = []
+	convert_row_ids = set()
+	for row_index, (fobj, row_id) in enumerate(zip(csv_rows, row_ids)):
+		# Rows that appear more than once in the csv are converted once
+		if(not row_id in converted_rows and not row_id in convert_row_ids):
+			convert_rows.append((row_index, fobj))
+			convert_row_ids.add(row_id)
 
-						if(not "type" in obj[key]):
-							obj[key]["type"] = "tf.float32"
-					except:
-						# If it fails the try saving it as a bytes feature
-						# encode the string
-						feature[key] = _bytes_feature(obj[key].encode())
+	pool = None
+	if(args.workers > 1):
+		print("Converting with", args.workers, "workers")
+		pool = multiprocessing.Pool(args.workers)
+		# imap keeps the order of the rows, the records and the description do not depend on the number of workers
+		if(args.slice):
+			converted = imap_bounded(pool, convert, convert_rows, 2*args.workers)
+		else:
+			converted = pool.imap(convert, convert_rows, chunksize=args.chunksize)
+	else:
+		# The examples are written while they are built
+		converted = map(convert, convert_rows)
 
-						if(not "shape" in obj[key]):
-							obj[key]["shape"] = [1]
+	# Rows written to the shard that is still open. They are added to the manifest when the shard is closed
+	pending_rows = {}
 
-						if(not "type" in obj[key]):
-							obj[key]["type"] = "tf.string"
-		
-			if("tfRecord" in fobj):
-				record_path = fobj["tfRecord"]
-			else:
-				record_path = os.path.join(args.out, str(uuid.uuid4()) + ".tfrecord")
+	for (row_index, fobj), (examples, description, error) in zip(convert_rows, converted):
+
+		try:
+
+			if(error):
+				raise error
+
+			row_id = row_ids[row_index]
+
+			duplicate_of = None
+			if(args.dedup):
+				duplicate_of = dedup_index.find(description[args.dedup]["phash"])
+				if(duplicate_of is None):
+					dedup_index.add(row_id, description[args.dedup]["phash"], fobj[args.dedup])
+				elif(args.dedup_action == "skip"):
+					print("Skipping duplicate", fobj[args.dedup], "of", duplicate_of)
+					entry = {}
+					entry["sources"] = rows_sources[row_index]
+					entry["description"] = {}
+					entry["records"] = []
+					entry["duplicate_of"] = duplicate_of
+					manifest.add(row_id, entry)
+					continue
+
+			records = []
+			row_description = None
+			for serialized, fields, example_description in examples:
+				# The examples are checked before they are written, the global description is modified when the row is complete
+				check_description(obj, example_description, fobj)
+				if(row_description is None):
+					row_description = example_description
+				else:
+					merge_description(row_description, example_description, fobj, args.histogram_bins)
 
-			fobj["tfRecord"] = record_path
+				record_path = None
+				if("tfRecord" in fobj and not record_writer.sharded and not args.slice):
+					record_path = fobj["tfRecord"]
 
-			writer = tf.python_io.TFRecordWriter(record_path)
-			example = tf.train.Example(features=tf.train.Features(feature=feature))
+				record = {}
+				record["tfRecord"], record["index"], record["offset"] = record_writer.write(serialized, record_path)
+				record["size"] = len(serialized) + 16
+				# Slice axis and index
+				record.update(fields)
 
-			print("Writing record", fobj)
+				if(record_writer.sharded and record["index"] == 0):
+					# A new shard was opened, the rows in the previous shard are complete
+					for pending_id in pending_rows:
+						manifest.add(pending_id, pending_rows[pending_id])
+					pending_rows = {}
+					manifest.flush()
 
-			writer.write(example.SerializeToString())
-			writer.close()
+				records.append(record)
+
+			for key in description:
+				row_description[key].update(description[key])
+			description = row_description
+			merge_description(obj, description, fobj, args.histogram_bins)
+
+			entry = {}
+			entry["sources"] = rows_sources[row_index]
+			entry["description"] = description
+			entry["records"] = records
+			if(duplicate_of is not None):
+				entry["duplicate_of"] = duplicate_of
+
+			if(record_writer.sharded):
+				pending_rows[row_id] = entry
+			else:
+				manifest.add(row_id, entry)
+				if(len(manifest.rows) % args.manifest_interval == 0):
+					manifest.flush()
+
+			print("Writing", len(records), "records", fobj)
 
 		except Exception as e:
-			print("Error converting to tfRecord", obj, e, file=sys.stderr)
+			print("Error converting to tfRecord", fobj, e, file=sys.stderr)
 			print("I'll keep on going...")
 
+	record_writer.close()
+	for pending_id in pending_rows:
+		manifest.add(pending_id, pending_rows[pending_id])
+	manifest.flush()
+
+	if(args.dedup):
+		dedup_index.save()
+
+	if(pool):
+		pool.close()
+		pool.join()
+
+	# The description, the output csv and the index are built from the manifest, the rows that are up to date are not read again
+	label_values = set()
+	index_rows = []
+	# The byte offsets and sizes of the records are only meaningful in uncompressed shards
+	index_fields = ["tfRecord", "index"] if args.compression else ["tfRecord", "index", "offset", "size"]
+	# Rows of the output csv, one per record. Sliced volumes have one row per slice
+	out_rows = []
+	# Records of every class of the enumerate column and number of records in every file
+	class_records = {}
+	file_records = {}
+
+	for row_index, (fobj, row_id) in enumerate(zip(csv_rows, row_ids)):
+		if(not row_id in manifest.rows):
+			out_rows.append(fobj)
+			continue
+
+		entry = manifest.rows[row_id]
+
+		if("duplicate_of" in entry):
+			# Near duplicate rows are reported in the output csv
+			fobj["duplicate_of"] = entry["duplicate_of"]
+
+		if(len(entry["records"]) == 0):
+			out_rows.append(fobj)
+
+		if(args.enumerate and "labels" in entry["description"].get(args.enumerate, {})):
+			label_values.update(entry["description"][args.enumerate]["labels"])
+
+		for record in entry["records"]:
+			out_row = dict(fobj)
+			out_row["tfRecord"] = record["tfRecord"]
+			if(record_writer.sharded):
+				out_row["tfRecord_index"] = record["index"]
+				if(not args.compression):
+					out_row["tfRecord_offset"] = record["offset"]
+			for field in ["slice_axis", "slice_index"]:
+				if(field in record):
+					out_row[field] = record[field]
+			out_rows.append(out_row)
+
+			index_row = {"row": len(out_rows) - 1}
+			for field in index_fields:
+				index_row[field] = record[field]
+			index_rows.append(index_row)
+
+			file_records[record["tfRecord"]] = max(file_records.get(record["tfRecord"], 0), record["index"] + 1)
+			if(args.enumerate and fobj[args.enumerate] in obj[args.enumerate]["class"]):
+				class_number = obj[args.enumerate]["class"][fobj[args.enumerate]]
+				if(not class_number in class_records):
+					class_records[class_number] = []
+				class_records[class_number].append(record)
+
+	if(args.enumerate):
+		# The new label values are sorted so the class number does not depend on the order of the rows. The classes are saved
+		# in the manifest, the values of a previous conversion keep their number. The keys are strings as in the JSON files
+		for class_label in sorted(label_values):
+			if(not str(class_label) in obj[args.enumerate]["class"]):
+				obj[args.enumerate]["class"][str(class_label)] = num_class
+				num_class += 1
+		manifest.classes = dict(obj[args.enumerate]["class"])
+		#Put the total of elements for convenience
+		obj[args.enumerate]["num_class"] = num_class
+
+		if(len(class_records) > 0):
+			# Number of records of every class and the records of every class, used by the readers to sample the classes
+			obj[args.enumerate]["class_count"] = dict([(class_name, len(class_records.get(class_number, []))) for class_name, class_number in obj[args.enumerate]["class"].items()])
+			obj[args.enumerate]["class_manifest"] = write_class_manifest(args.out.rstrip(os.sep) + "_class.txt", class_records, file_records, record_writer.sharded)
+
+		print(obj[args.enumerate])
+
+	manifest.save()
+
+	for key in row_keys:
+		if(key in obj and "stats" in obj[key]):
+			# Mean, variance, histogram and percentiles per channel of the image
+			obj[key].update(finalize_stats(obj[key].pop("stats")))
+
 	obj['tfrecords'] = os.path.basename(args.out.rstrip(os.sep))
+
+	if(record_writer.sharded):
+		# The index maps every row of the output csv to the shard, the position in the shard and, without compression, the byte offset of its record
+		outindex = args.out.rstrip(os.sep) + "_index.csv"
+		print("Writing:", outindex, "with", len(manifest.record_paths()), "shards")
+		with open(outindex, "w") as f:
+			writer = csv.DictWriter(f, fieldnames=["row"] + index_fields)
+			writer.writeheader()
+			for row in index_rows:
+				writer.writerow(row)
+		obj["index"] = os.path.basename(outindex)
 	
 	outjson = args.out.rstrip(os.sep) + ".json"
 	print("Writing:", outjson)
@@ -270,15 +1072,19 @@ def main(args):
 		f.write(json.dumps(obj))
 	
 	outcsv = None
-	if(len(csv_rows) > 0):
+	if(len(out_rows) > 0):
 		outcsv = os.path.splitext(args.csv)[0] + "_tfRecords.csv"
 		print("Writing:", outcsv)
-		csv_headers = list(csv_rows[0].keys())
+		csv_headers = []
+		for row in out_rows:
+			for key in row.keys():
+				if(not key in csv_headers):
+					csv_headers.append(key)
 		print(csv_headers)
 		with open(outcsv, "w") as f:
 			writer = csv.DictWriter(f, fieldnames=csv_headers)
 			writer.writeheader()
-			for row in csv_rows:
+			for row in out_rows:
 				writer.writerow(row)
 
 	if(args.split > 0 and args.split < 1):
@@ -287,6 +1093,10 @@ def main(args):
 		split_obj["json"] = outjson
 		split_obj["split"] = args.split
 		split_obj["csv"] = outcsv
+		split_obj["stratify"] = None
+		split_obj["group"] = None
+		split_obj["folds"] = 0
+		split_obj["seed"] = None
 
 		# We convert the dictionary to a namedtuple, a.k.a, python object, i.e., argparse object
 		split_args = namedtuple("Split", split_obj.keys())(*split_obj.values())
@@ -299,9 +1109,24 @@ if __name__ == "__main__":
 	parser.add_argument('--csv', type=str, help='CSV file with dataset information,', required=True)
 	parser.add_argument('--enumerate', type=str, default=None, help='Column name in CSV. If you are storing a label or category to perform a classification task. If it is an image, it will read the FIRST image in your csv and extract the existing labels.')
 	parser.add_argument('--slice', type=bool, default=False, help="If it is a 3D image, saves slices in all the major axis and the stores them as tfRecords")
-	parser.add_argument('--resize', nargs="+", type=int, default=None, help='Resize images to store as tfRecord. The resize parameter must be equal or larger than the largest image in the dataset. Do not include channels and flip axes, i.e, z y x or y x for 3D, 2D images respectively')
+	parser.add_argument('--resize', nargs="+", type=int, default=None, help='Resize images to store as tfRecord. With --resize_mode pad, the resize parameter must be equal or larger than the largest image in the dataset. Do not include channels and flip axes, i.e, z y x or y x for 3D, 2D images respectively')
+	parser.add_argument('--resize_mode', type=str, default="pad", choices=["pad", "crop", "resample"], help="pad: place the image at a random offset in a zero image of size --resize. crop: pad or crop each dimension at a random offset. resample: interpolate the images to --resize (the --label_keys and --enumerate columns use nearest neighbor)")
+	parser.add_argument('--label_keys', nargs="+", type=str, default=None, help="Image columns with label maps, i.e., the segmentation target. They are resampled with nearest neighbor interpolation, the --enumerate column is always a label map. Saved in the JSON description for the readers and predict.py")
+	parser.add_argument('--variable_shape', action='store_true', help="Images of different sizes keep their shape, it is stored in the <key>_shape feature. The readers bucket the images by size and pad each batch to its largest image")
 	parser.add_argument('--out', type=str, default="./out", help="Output directory")
 	parser.add_argument('--split', type=float, default=0, help="Split the data for evaluation. [0-1], 0=no split")
+	parser.add_argument('--encoding', type=str, default="float", choices=["float", "raw"], help="Encoding of the image features. 'float' stores a list of floats, 'raw' stores the pixel buffer as bytes in its native type (uint8, uint16, float32...) and is decoded in the graph")
+	parser.add_argument('--examples_per_shard', type=int, default=1, help="Number of examples written to each tfRecord file. 1 writes one file per row. The output csv and the <out>_index.csv file map every row to its shard and position in the shard, and to the byte offset of its record if the shards are not compressed")
+	parser.add_argument('--shard_size_mb', type=float, default=0, help="Starts a new tfRecord shard when the current one reaches this size in MB. 0=no size limit")
+	parser.add_argument('--compression', type=str, default=None, choices=["GZIP", "ZLIB"], help="Compress the tfRecords. The compression type is saved in the JSON description and used by the readers. The byte offsets are not written to the output csv and the index, they only apply to uncompressed shards")
+	parser.add_argument('--histogram_bins', type=int, default=64, help="Maximum number of bins of the intensity histograms in the JSON description. The mean, variance, histogram and percentiles of every image column are computed in the conversion pass")
+	parser.add_argument('--dedup', type=str, default=None, help="Image column used to find near duplicate rows. A perceptual hash of every image is compared with the hashes of the rows already in the dataset, the index is saved in <out>_phash.json")
+	parser.add_argument('--dedup_distance', type=int, default=4, help="Maximum hamming distance between the 64 bit perceptual hashes of near duplicate images")
+	parser.add_argument('--dedup_action', type=str, default="skip", choices=["skip", "flag"], help="skip: near duplicate rows are not written to the tfRecords. flag: they are written. In both cases the output csv has a duplicate_of column")
+	parser.add_argument('--rebuild', action='store_true', help="Ignore the conversion manifest <out>_manifest.json and convert all the rows. The tfRecords in the output directory that are not in the manifest are removed, i.e., records of a conversion without manifest or of another csv. By default, only new or modified rows are converted, an interrupted conversion resumes where it stopped and only the records created by a previous conversion are removed")
+	parser.add_argument('--manifest_interval', type=int, default=1000, help="Number of rows converted between flushes of the manifest journal when one record is written per file. In sharded mode, the journal is flushed when a shard is complete. The journal is compacted into the manifest at the end of the conversion")
+	parser.add_argument('--workers', type=int, default=1, help="Number of processes used to read the images and build the records. The output does not depend on the number of workers")
+	parser.add_argument('--chunksize', type=int, default=16, help="Number of rows sent to a worker at a time (only used if workers > 1). With --slice every worker converts one volume at a time and at most 2*workers converted volumes wait to be written")
 
 	args = parser.parse_args()
 
@@ -0,0 +1,127 @@
+import argparse
+import os
+import glob
+import numpy as np
+import tensorflow as tf
+import sys
+import json
+import time
+
+def get_compression_options(compression):
+	if(compression and compression != "NONE"):
+		return tf.python_io.TFRecordOptions(getattr(tf.python_io.TFRecordCompressionType, compression))
+	return None
+
+def read_records(json_filename, data_description, num_samples):
+	# Reads the first num_samples serialized examples of the dataset described in the json file
+	tfrecords_arr = []
+	tfrecords_dir = os.path.join(os.path.dirname(json_filename), data_description["tfrecords"], '**/*.tfrecord')
+	for tfr in glob.iglob(tfrecords_dir, recursive=True):
+		tfrecords_arr.append(tfr)
+	tfrecords_arr.sort()
+
+	options = get_compression_options(data_description.get("compression"))
+
+	records = []
+	for tfr in tfrecords_arr:
+		for record in tf.python_io.tf_record_iterator(tfr, options=options):
+			records.append(record)
+			if(len(records) >= num_samples):
+				return records
+	return records
+
+def write_records(records, out_dir, compression, examples_per_shard):
+	if(not os.path.exists(out_dir)):
+		os.makedirs(out_dir)
+
+	options = get_compression_options(compression)
+	filenames = []
+	for shard, start in enumerate(range(0, len(records), examples_per_shard)):
+		filename = os.path.join(out_dir, "shard-%05d.tfrecord" % shard)
+		writer = tf.python_io.TFRecordWriter(filename, options=options)
+		for record in records[start:start + examples_per_shard]:
+			writer.write(record)
+		writer.close()
+		filenames.append(filename)
+	return filenames
+
+def read_throughput(filenames, compression, repeat):
+	# Reads all the records with tf.data and returns the number of records and the elapsed time
+	graph = tf.Graph()
+	with graph.as_default():
+		dataset = tf.data.TFRecordDataset(filenames, compression_type=compression if compression != "NONE" else "")
+		dataset = dataset.batch(256)
+		dataset = dataset.repeat(repeat)
+		iterator = dataset.make_one_shot_iterator()
+		next_records = iterator.get_next()
+
+		with tf.Session() as sess:
+			num_records = 0
+			start = time.time()
+			while True:
+				try:
+					num_records += len(sess.run(next_records))
+				except tf.errors.OutOfRangeError:
+					break
+			elapsed = time.time() - start
+
+	return num_records, elapsed
+
+def main(args):
+
+	with open(args.json, "r") as f:
+		data_description = json.load(f)
+
+	records = read_records(args.json, data_description, args.samples)
+	if(len(records) == 0):
+		print("No records found for", args.json, file=sys.stderr)
+		sys.exit(1)
+
+	raw_size = sum([len(record) for record in records])
+	print("Benchmarking", len(records), "records,", raw_size/(1024*1024), "MB of serialized examples")
+
+	results = {}
+	results["json"] = args.json
+	results["samples"] = len(records)
+	results["serialized_bytes"] = raw_size
+	results["compression"] = {}
+
+	for compression in args.compression:
+		out_dir = os.path.join(args.out, compression)
+
+		start = time.time()
+		filenames = write_records(records, out_dir, compression, args.examples_per_shard)
+		write_elapsed = time.time() - start
+
+		disk_size = sum([os.path.getsize(filename) for filename in filenames])
+		num_records, read_elapsed = read_throughput(filenames, compression, args.repeat)
+
+		result = {}
+		result["disk_bytes"] = disk_size
+		result["ratio"] = float(raw_size)/disk_size
+		result["write_secs"] = write_elapsed
+		result["read_secs"] = read_elapsed
+		result["records_per_sec"] = num_records/read_elapsed
+		result["mb_per_sec"] = (raw_size*args.repeat/(1024*1024))/read_elapsed
+		results["compression"][compression] = result
+
+		print("%s: disk = %.2f MB | ratio = %.2f | read = %.1f records/sec | %.2f MB/sec (uncompressed)" % (compression, disk_size/(1024*1024), result["ratio"], result["records_per_sec"], result["mb_per_sec"]))
+
+	outjson = os.path.join(args.out, "benchmark.json")
+	print("Writing:", outjson)
+	with open(outjson, "w") as f:
+		f.write(json.dumps(results))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Compares the disk footprint and the read throughput of uncompressed and compressed tfRecords. A sample of the dataset created by tfRecords.py is rewritten with each compression type and read back with tf.data')
+
+	parser.add_argument('--json', type=str, help='JSON file created by tfRecords.py', required=True)
+	parser.add_argument('--samples', type=int, default=1000, help='Number of records used for the benchmark')
+	parser.add_argument('--compression', nargs="+", type=str, default=["NONE", "GZIP", "ZLIB"], help='Compression types to compare')
+	parser.add_argument('--examples_per_shard', type=int, default=256, help='Number of records per file')
+	parser.add_argument('--repeat', type=int, default=3, help='Number of times the records are read')
+	parser.add_argument('--out', type=str, default="./benchmark", help='Output directory for the rewritten records and the benchmark.json results')
+
+	args = parser.parse_args()
+
+	main(args)
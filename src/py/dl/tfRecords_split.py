@@ -6,104 +6,177 @@ import sys
 import json
 import csv
 
+def list_records(json_filename, data_description):
+	# Lists the records of the dataset as (path, index) pairs. The paths are relative to the directory of the JSON file.
+	# If the records are sharded, the index csv written by tfRecords.py gives the position of every record in its shard,
+	# otherwise, every file has a single record and the index is None
+	json_dir = os.path.dirname(json_filename)
+	records = []
+	num_records = {}
+
+	if("index" in data_description):
+		with open(os.path.join(json_dir, data_description["index"])) as csvfile:
+			for row in csv.DictReader(csvfile):
+				tfr = os.path.join(data_description["tfrecords"], os.path.basename(row["tfRecord"]))
+				records.append((tfr, int(row["index"])))
+				num_records[tfr] = max(num_records.get(tfr, 0), int(row["index"]) + 1)
+	else:
+		tfrecords_dir = os.path.join(json_dir, data_description["tfrecords"], '**/*.tfrecord')
+		for tfr in glob.iglob(tfrecords_dir, recursive=True):
+			tfr = os.path.relpath(tfr, json_dir)
+			records.append((tfr, None))
+			num_records[tfr] = 1
+
+	return records, num_records
+
+def write_manifest(filename, records, num_records):
+	# One line per file. For sharded records, the line has the number of records in the shard
+	# and the indices of the records in the split, i.e., path<TAB>num_records<TAB>index,index...
+	shards = {}
+	for tfr, index in records:
+		if(not tfr in shards):
+			shards[tfr] = []
+		if(index is not None):
+			shards[tfr].append(index)
+
+	print("Writing:", filename, "with", len(records), "records")
+	with open(filename, "w") as f:
+		for tfr in sorted(shards):
+			if(len(shards[tfr]) > 0):
+				f.write(tfr + "\t" + str(num_records[tfr]) + "\t" + ",".join([str(index) for index in sorted(shards[tfr])]) + "\n")
+			else:
+				f.write(tfr + "\n")
+
+def write_split(json_filename, data_description, split_name, records, num_records):
+	# The split is described by a JSON file that points to the manifest, the records are not copied or linked
+	split_base = os.path.join(os.path.dirname(json_filename), data_description["tfrecords"] + "_split_" + split_name)
+
+	write_manifest(split_base + ".txt", records, num_records)
+
+	data_description_split = {}
+	data_description_split.update(data_description)
+	data_description_split["manifest"] = os.path.basename(split_base + ".txt")
+
+	with open(split_base + ".json", "w") as f:
+		f.write(json.dumps(data_description_split))
+
+def record_key(tfr, index):
+	# Key used to match the records in the output csv of tfRecords.py with the records in the split
+	if(index is not None):
+		return (os.path.basename(tfr), int(index))
+	return os.path.basename(tfr)
+
+def assign_folds(labels, groups, split=0, folds=0):
+	# Assigns every record to a fold. Records of the same group are assigned to the same fold and the groups of each label
+	# are distributed evenly across the folds, i.e., stratified. With folds=0, fold 1 is the evaluation split and fold 0 the training split
+	# The groups are shuffled before the assignment so np.random.seed controls the split
+	group_values, group_first, group_inverse = np.unique(groups, return_index=True, return_inverse=True)
+
+	# The label of a group is the label of its first record
+	_, group_labels = np.unique(labels[group_first], return_inverse=True)
+
+	perm = np.random.permutation(len(group_values))
+	perm = perm[np.argsort(group_labels[perm], kind="stable")]
+	sorted_labels = group_labels[perm]
+
+	# Position of every group within its label
+	_, label_start, label_counts = np.unique(sorted_labels, return_index=True, return_counts=True)
+	position = np.arange(len(perm)) - label_start[sorted_labels]
+
+	group_fold = np.zeros(len(group_values), dtype=int)
+	if(folds > 1):
+		# The groups are sorted by label, consecutive groups go to consecutive folds
+		group_fold[perm] = np.arange(len(perm)) % folds
+	else:
+		# Every label with more than one group has at least one group in each split
+		num_eval = np.round(label_counts*split).astype(int)
+		if(split > 0):
+			num_eval = np.where(label_counts > 1, np.clip(num_eval, 1, label_counts - 1), 0)
+		group_fold[perm] = (position < num_eval[sorted_labels]).astype(int)
+
+	return group_fold[group_inverse]
+
+def write_csv(filename, row_keys, rows):
+	print("Writing:", filename)
+	with open(filename, "w") as f:
+		writer = csv.DictWriter(f, fieldnames=row_keys)
+		writer.writeheader()
+		for row in rows:
+			writer.writerow(row)
+
 def main(args):
-	
+
 	json_filename = args.json
 	data_description = {}
 
 	with open(json_filename, "r") as f:
 		data_description = json.load(f)
 
-	tfrecords_arr = []
-	tfrecords_dir = os.path.join(os.path.dirname(json_filename), data_description["tfrecords"], '**/*.tfrecord')
-	for tfr in glob.iglob(tfrecords_dir, recursive=True):
-		tfrecords_arr.append(tfr)
-
-	tfrecords_arr = np.array(tfrecords_arr)
-	tfrecords_arr = tfrecords_arr[np.random.permutation(tfrecords_arr.size)]
-
-	train_samples = int(tfrecords_arr.size - tfrecords_arr.size*args.split)
-
-	tfrecords_train_dir = os.path.join(os.path.dirname(json_filename), data_description["tfrecords"] + "_split_train")
-	data_description_train  = {}
-	data_description_train.update(data_description)
-	data_description_train["tfrecords"] = os.path.basename(tfrecords_train_dir)
-
-	if(not os.path.exists(tfrecords_train_dir)):
-		os.makedirs(tfrecords_train_dir)
-
-	for tfr in tfrecords_arr[0:train_samples]:
-		try:
-			dest = os.path.join(tfrecords_train_dir, os.path.basename(tfr))
-			print("Creating soft link: ", dest)
-			os.symlink(tfr, dest)
-		except Exception as e:
-			print("Error making symlink", e, file=sys.stderr)
-
-	tfrecords_train_json = tfrecords_train_dir.rstrip(os.sep) + ".json"
-	with open(tfrecords_train_json, "w") as f:
-		f.write(json.dumps(data_description_train))
-
-	tfrecords_eval_dir = os.path.join(os.path.dirname(json_filename), data_description["tfrecords"] + "_split_eval")
-	data_description_eval  = {}
-	data_description_eval.update(data_description)
-	data_description_eval["tfrecords"] = os.path.basename(tfrecords_eval_dir)
-
-	if(not os.path.exists(tfrecords_eval_dir)):
-		os.makedirs(tfrecords_eval_dir)
-
-	for tfr in tfrecords_arr[train_samples:]:
-		try:
-			dest = os.path.join(tfrecords_eval_dir, os.path.basename(tfr))
-			print("Creating soft link: ", dest)
-			os.symlink(tfr, dest)
-		except Exception as e:
-			print("Error making symlink", e, file=sys.stderr)
-	
-	tfrecords_eval_json = tfrecords_eval_dir.rstrip(os.sep) + ".json"
-	with open(tfrecords_eval_json, "w") as f:
-		f.write(json.dumps(data_description_eval))
+	records, num_records = list_records(json_filename, data_description)
 
+	csv_rows = []
+	row_keys = []
 	if(args.csv):
 		with open(args.csv) as csvfile:
-
 			csv_reader = csv.DictReader(csvfile)
 			row_keys = csv_reader.fieldnames.copy()
-
 			if("tfRecord" in row_keys):
-				tf_train_array = []
-				tf_eval_array = []
-				for row in csv_reader:
-					tfrecord_filename = os.path.join(tfrecords_train_dir, os.path.basename(row["tfRecord"]))
-					if(os.path.isfile(tfrecord_filename)):
-						tf_train_array.append(row)
-
-					tfrecord_filename = os.path.join(tfrecords_eval_dir, os.path.basename(row["tfRecord"]))
-					if(os.path.isfile(tfrecord_filename)):
-						tf_eval_array.append(row)
-
-				if(len(tf_train_array) > 0):
-					outcsv = os.path.splitext(args.csv)[0] + "_train.csv"
-					with open(outcsv, "w") as f:
-						writer = csv.DictWriter(f, fieldnames=row_keys)
-						writer.writeheader()
-						for row in tf_train_array:
-							writer.writerow(row)
-
-				if(len(tf_eval_array) > 0):
-					outcsv = os.path.splitext(args.csv)[0] + "_eval.csv"
-					with open(outcsv, "w") as f:
-						writer = csv.DictWriter(f, fieldnames=row_keys)
-						writer.writeheader()
-						for row in tf_eval_array:
-							writer.writerow(row)
+				csv_rows = [row for row in csv_reader if row["tfRecord"] != ""]
+
+	if((args.stratify or args.group) and len(csv_rows) == 0):
+		print("--stratify and --group need the csv file created by tfRecords.py with the tfRecord column", file=sys.stderr)
+		sys.exit(1)
+
+	if(args.seed is not None):
+		np.random.seed(args.seed)
+
+	if(len(csv_rows) > 0):
+		# The records are the rows of the csv, the label and the group of every record are read from its row
+		records_dict = dict([(record_key(tfr, index), (tfr, index)) for tfr, index in records])
+		csv_rows = [row for row in csv_rows if record_key(row["tfRecord"], row.get("tfRecord_index")) in records_dict]
+		records = [records_dict[record_key(row["tfRecord"], row.get("tfRecord_index"))] for row in csv_rows]
+		labels = np.array([row[args.stratify] if args.stratify else "" for row in csv_rows])
+		groups = np.array([row[args.group] if args.group else str(i) for i, row in enumerate(csv_rows)])
+	else:
+		labels = np.array([""]*len(records))
+		groups = np.arange(len(records))
+
+	if(len(records) == 0):
+		print("No records found for", json_filename, file=sys.stderr)
+		sys.exit(1)
+
+	record_fold = assign_folds(labels, groups, split=args.split, folds=args.folds)
+
+	if(args.folds > 1):
+		splits = []
+		for fold in range(args.folds):
+			splits.append(("fold%d_train" % fold, record_fold != fold))
+			splits.append(("fold%d_eval" % fold, record_fold == fold))
+	else:
+		splits = [("train", record_fold == 0), ("eval", record_fold == 1)]
+
+	for split_name, split_mask in splits:
+		split_records = [record for record, in_split in zip(records, split_mask) if in_split]
+		write_split(json_filename, data_description, split_name, split_records, num_records)
+
+		if(len(csv_rows) > 0):
+			split_rows = [row for row, in_split in zip(csv_rows, split_mask) if in_split]
+			if(args.stratify):
+				split_labels, split_counts = np.unique(labels[split_mask], return_counts=True)
+				print(split_name, dict(zip(split_labels.tolist(), split_counts.tolist())))
+			if(len(split_rows) > 0):
+				write_csv(os.path.splitext(args.csv)[0] + "_" + split_name + ".csv", row_keys, split_rows)
 
 if __name__ == "__main__":
-	parser = argparse.ArgumentParser(description='Splits the data by creating soft links and new folders for training and evaluation purposes')
-	
+	parser = argparse.ArgumentParser(description='Splits the data for training and evaluation purposes. Each split is a manifest file with the list of records (and their position in the shard if the records are sharded) and a JSON description that points to it')
+
 	parser.add_argument('--json', type=str, help='JSON file created by tfRecords.py', required=True)
 	parser.add_argument('--split', type=float, default=0, help="Split the data for evaluation. [0-1], 0=no split")
-	parser.add_argument('--csv', type=str, default=None, help="If provided, generates the corresponding CSV files for the splitted dataset")
+	parser.add_argument('--csv', type=str, default=None, help="If provided, generates the corresponding CSV files for the splitted dataset. Use the csv created by tfRecords.py, it is required by --stratify and --group")
+	parser.add_argument('--stratify', type=str, default=None, help="Column in the csv used to stratify the splits, i.e., the --enumerate column of tfRecords.py. Every class is distributed across the splits or folds")
+	parser.add_argument('--group', type=str, default=None, help="Column in the csv with a group id, i.e., study or patient. The records of a group are never in different splits")
+	parser.add_argument('--folds', type=int, default=0, help="Generates k folds instead of a single split, <tfrecords>_split_fold<k>_train/eval. 0=single split with --split")
+	parser.add_argument('--seed', type=int, default=None, help="Seed of the random split")
 
 	args = parser.parse_args()
 
@@ -8,6 +8,8 @@ import os
 from datetime import datetime
 import json
 import glob
+import sys
+import train_utils
 
 print("Tensorflow version:", tf.__version__)
 
@@ -30,6 +32,25 @@ parser.add_argument('--staircase', help='staircase decay', type=bool, default=Fa
 parser.add_argument('--batch_size', help='Batch size for evaluation', type=int, default=8)
 parser.add_argument('--num_epochs', help='Number of epochs', type=int, default=10)
 parser.add_argument('--buffer_size', help='Shuffle buffer size', type=int, default=1000)
+parser.add_argument('--shuffle_mem_mb', help='Memory budget in MB of the shuffle buffers. The buffer sizes are computed from the record size in the description, buffer_size is the maximum number of decoded records', type=float, default=None)
+parser.add_argument('--num_parallel_reads', help='Number of tfRecord files read in parallel, default is the number of cpus', type=int, default=None)
+parser.add_argument('--num_parallel_calls', help='Number of records decoded in parallel, default is autotune', type=int, default=None)
+parser.add_argument('--prefetch_buffer_size', help='Number of batches prefetched while training, default is autotune', type=int, default=None)
+parser.add_argument('--shuffle_files', help='Shuffle the order of the tfRecord files every epoch, 0 or 1', type=int, default=1)
+parser.add_argument('--batch_parse', help='Batch the serialized records and decode each batch with a single parse op, 0 or 1', type=int, default=0)
+parser.add_argument('--cache', help='Cache the decoded records after the first epoch. "memory" or a local directory for a cache file. The next epochs read the records in the order of the first epoch, only the shuffle buffer (buffer_size or shuffle_mem_mb) mixes them', type=str, default=None)
+parser.add_argument('--augmentation', help='JSON file or JSON string with the random transformations applied to the training records, i.e., {"flip": [1], "translate": 8, "rotate": 10, "gain": 0.1, "contrast": 0.1, "noise": 0.05}', type=str, default=None)
+parser.add_argument('--class_sampling', help='Sample the classes of the enumerate column from separate datasets. "balanced" or a JSON file or JSON string with the weight of each class name', type=str, default=None)
+parser.add_argument('--log_steps', help='Run the summaries and the metrics every log_steps steps, the other steps only run the training op', type=int, default=100)
+parser.add_argument('--log_secs', help='Run the summaries and the metrics every log_secs seconds, can be combined with log_steps', type=float, default=None)
+parser.add_argument('--checkpoint_steps', help='Write a checkpoint every checkpoint_steps steps', type=int, default=1000)
+parser.add_argument('--checkpoint_secs', help='Write a checkpoint every checkpoint_secs seconds, can be combined with checkpoint_steps', type=float, default=None)
+parser.add_argument('--max_to_keep', help='Number of recent checkpoints of the run kept, 0 keeps all the checkpoints. The checkpoints are named <model>-<run>-<step>, the checkpoints of other runs are not removed', type=int, default=5)
+parser.add_argument('--keep_best', help='Number of checkpoints with the lowest mean training loss (of the steps since the previous checkpoint) kept in addition to the recent ones', type=int, default=0)
+parser.add_argument('--save_iterator', help='Save the position of the input pipeline with the checkpoints so --resume continues in the same epoch position. The state has the records in the shuffle and prefetch buffers (about buffer_size decoded records, bounded with shuffle_mem_mb) and it is serialized in the training loop to a local temporary directory. Without it, --resume restarts the interrupted epoch. 0 or 1', type=int, default=0)
+parser.add_argument('--resume', help='Resume the training from the last complete checkpoint written in the output directory and continue its run, i.e., the variables, the global step and the position of the input pipeline. 0 or 1', type=int, default=0)
+parser.add_argument('--perf', help='Measure examples/sec, step time percentiles, the fraction of the step waiting for the input pipeline and the memory of the process in the logging steps. Written to tensorboard and to perf.jsonl in the summary directory, 0 or 1', type=int, default=0)
+train_utils.add_session_args(parser)
 parser.add_argument('--ps_device', help='Process device', type=str, default='/cpu:0')
 parser.add_argument('--w_device', help='Worker device', type=str, default='/cpu:0')
 
@@ -47,6 +68,26 @@ staircase = args.staircase
 batch_size = args.batch_size
 num_epochs = args.num_epochs
 buffer_size = args.buffer_size
+shuffle_mem_mb = args.shuffle_mem_mb
+num_parallel_reads = args.num_parallel_reads
+num_parallel_calls = args.num_parallel_calls
+prefetch_buffer_size = args.prefetch_buffer_size
+shuffle_files = args.shuffle_files
+batch_parse = args.batch_parse
+cache = args.cache
+augmentation = args.augmentation
+class_sampling = args.class_sampling
+log_steps = args.log_steps
+log_secs = args.log_secs
+checkpoint_steps = args.checkpoint_steps
+checkpoint_secs = args.checkpoint_secs
+max_to_keep = args.max_to_keep
+keep_best = args.keep_best
+save_iterator = args.save_iterator
+resume = args.resume
+perf = args.perf
+session_args = dict([(arg, vars(args)[arg]) for arg in train_utils.SESSION_ARGS])
+session_config = args.session_config
 ps_device = args.ps_device
 w_device = args.w_device
 
@@ -65,9 +106,44 @@ if(args.args):
     batch_size = json_args["batch_size"] if json_args["batch_size"] else args.batch_size
     num_epochs = json_args["num_epochs"] if json_args["num_epochs"] else args.num_epochs
     buffer_size = json_args["buffer_size"] if json_args["buffer_size"] else args.buffer_size
+    shuffle_mem_mb = json_args["shuffle_mem_mb"] if "shuffle_mem_mb" in json_args else args.shuffle_mem_mb
+    num_parallel_reads = json_args["num_parallel_reads"] if "num_parallel_reads" in json_args else args.num_parallel_reads
+    num_parallel_calls = json_args["num_parallel_calls"] if "num_parallel_calls" in json_args else args.num_parallel_calls
+    prefetch_buffer_size = json_args["prefetch_buffer_size"] if "prefetch_buffer_size" in json_args else args.prefetch_buffer_size
+    shuffle_files = json_args["shuffle_files"] if "shuffle_files" in json_args else args.shuffle_files
+    batch_parse = json_args["batch_parse"] if "batch_parse" in json_args else args.batch_parse
+    cache = json_args["cache"] if "cache" in json_args else args.cache
+    augmentation = json_args["augmentation"] if "augmentation" in json_args else args.augmentation
+    class_sampling = json_args["class_sampling"] if "class_sampling" in json_args else args.class_sampling
+    log_steps = json_args["log_steps"] if "log_steps" in json_args else args.log_steps
+    log_secs = json_args["log_secs"] if "log_secs" in json_args else args.log_secs
+    checkpoint_steps = json_args["checkpoint_steps"] if "checkpoint_steps" in json_args else args.checkpoint_steps
+    checkpoint_secs = json_args["checkpoint_secs"] if "checkpoint_secs" in json_args else args.checkpoint_secs
+    max_to_keep = json_args["max_to_keep"] if "max_to_keep" in json_args else args.max_to_keep
+    keep_best = json_args["keep_best"] if "keep_best" in json_args else args.keep_best
+    save_iterator = json_args["save_iterator"] if "save_iterator" in json_args else args.save_iterator
+    resume = json_args["resume"] if "resume" in json_args else args.resume
+    perf = json_args["perf"] if "perf" in json_args else args.perf
+    for arg in train_utils.SESSION_ARGS:
+      if arg in json_args:
+        session_args[arg] = json_args[arg]
+    session_config = json_args["session_config"] if "session_config" in json_args else args.session_config
     ps_device = json_args["ps_device"] if json_args["ps_device"] else args.ps_device
     w_device = json_args["w_device"] if json_args["w_device"] else args.w_device
 
+if(isinstance(augmentation, str)):
+  if(os.path.exists(augmentation)):
+    with open(augmentation, "r") as f:
+      augmentation = json.load(f)
+  else:
+    augmentation = json.loads(augmentation)
+
+if(isinstance(class_sampling, str) and class_sampling != "balanced"):
+  if(os.path.exists(class_sampling)):
+    with open(class_sampling, "r") as f:
+      class_sampling = json.load(f)
+  else:
+    class_sampling = json.loads(class_sampling)
 
 nn = importlib.import_module("nn." + neural_network).NN()
 is_gan = "gan" in neural_network
@@ -84,18 +160,67 @@ print('decay_steps', decay_steps)
 print('batch_size', batch_size)
 print('num_epochs', num_epochs)
 print('buffer_size', buffer_size)
+print('shuffle_mem_mb', shuffle_mem_mb)
+print('num_parallel_reads', num_parallel_reads)
+print('num_parallel_calls', num_parallel_calls)
+print('prefetch_buffer_size', prefetch_buffer_size)
+print('shuffle_files', shuffle_files)
+print('batch_parse', batch_parse)
+print('cache', cache)
+print('augmentation', augmentation)
+print('class_sampling', class_sampling)
+print('log_steps', log_steps)
+print('log_secs', log_secs)
+print('checkpoint_steps', checkpoint_steps)
+print('checkpoint_secs', checkpoint_secs)
+print('max_to_keep', max_to_keep)
+print('keep_best', keep_best)
+print('save_iterator', save_iterator)
+print('resume', resume)
+print('perf', perf)
+print('session_args', session_args)
+print('session_config', session_config)
 print('ps_device', ps_device)
 print('w_device', w_device)
 
 
+resume_checkpoint = None
+if resume:
+  resume_checkpoint = train_utils.latest_checkpoint(outvariablesdirname, modelname)
+  if resume_checkpoint:
+    print('Resuming from:', resume_checkpoint["path"], 'step', resume_checkpoint["step"])
+  else:
+    print('No checkpoint found in', outvariablesdirname, 'training from the beginning', file=sys.stderr)
+
 graph = tf.Graph()
 
 with graph.as_default():
 
   nn.set_data_description(json_filename=json_filename)
+
+  if session_config:
+    session_args = train_utils.load_session_args(session_config, train_utils.session_key(neural_network, nn.get_data_description()), session_args)
+  config = train_utils.session_config(**session_args)
+
+  if resume_checkpoint and not (resume_checkpoint.get("iterator") and save_iterator):
+    # The position in the dataset was not saved, the completed epochs are skipped and the current epoch starts again
+    num_records = nn.get_num_records()
+    if num_records > 0:
+      num_epochs = max(1, num_epochs - (resume_checkpoint["step"] + 1)*batch_size//num_records)
+    print('Remaining epochs:', num_epochs)
+
   iterator = nn.inputs(batch_size=batch_size,
     num_epochs=num_epochs, 
-    buffer_size=buffer_size)
+    buffer_size=buffer_size,
+    num_parallel_reads=num_parallel_reads,
+    num_parallel_calls=num_parallel_calls,
+    prefetch_buffer_size=prefetch_buffer_size,
+    shuffle_files=bool(shuffle_files),
+    batch_parse=bool(batch_parse),
+    cache=cache,
+    augmentation=augmentation,
+    class_sampling=class_sampling,
+    shuffle_mem_mb=shuffle_mem_mb)
 
   data_tuple = iterator.get_next()
   
@@ -151,23 +276,46 @@ with graph.as_default():
 
     summary_op = tf.summary.merge_all()
 
-    with tf.Session() as sess:
+    # The checkpoints are written in the background, the snapshot variables are created before the initialization
+    checkpointer = train_utils.AsyncCheckpointer(outvariablesdirname, modelname, max_to_keep=max_to_keep, keep_best=keep_best, iterator=iterator if save_iterator else None, run_id=resume_checkpoint.get("run") if resume_checkpoint else None)
+
+    with tf.Session(config=config) as sess:
 
       sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
       saver = tf.train.Saver()
       # specify where to write the log files for import to TensorBoard
       now = datetime.now()
-      summary_writer = tf.summary.FileWriter(os.path.join(outvariablesdirname, modelname + "-" + now.strftime("%Y%m%d-%H%M%S")), sess.graph)
+      summary_path = os.path.join(outvariablesdirname, modelname + "-" + now.strftime("%Y%m%d-%H%M%S"))
+      summary_writer = tf.summary.FileWriter(summary_path, sess.graph)
 
       sess.run([iterator.initializer])
       step = 0
+      log_scheduler = train_utils.StepScheduler(steps=log_steps, secs=log_secs)
+      checkpoint_scheduler = train_utils.StepScheduler(steps=checkpoint_steps, secs=checkpoint_secs)
+      # Mean loss of the steps since the last checkpoint, the checkpoints are ranked with it for keep_best
+      checkpoint_loss = train_utils.RunningMean()
+      perf_monitor = train_utils.PerfMonitor(os.path.join(summary_path, "perf.jsonl"), summary_writer, batch_size) if perf else None
+
+      if resume_checkpoint:
+        # The global step is a variable of the checkpoint, the loop continues after the step of the checkpoint
+        checkpointer.restore(sess, resume_checkpoint)
+        step = resume_checkpoint["step"] + 1
+        checkpoint_scheduler.done(resume_checkpoint["step"])
 
       while True:
         try:
 
-          _d, _g, loss_value_d, loss_value_g, summary, metrics = sess.run([train_op_d, train_op_g, loss_d, loss_g, summary_op, metrics_eval], feed_dict={keep_prob: k_prob})
+          if perf_monitor:
+            perf_monitor.step_begin()
+
+          if log_scheduler.is_due(step):
+            # The summaries and the streaming metrics only run in the logging steps
+            run_options, run_metadata = perf_monitor.trace() if perf_monitor else (None, None)
+            _d, _g, loss_value_d, loss_value_g, summary, metrics = sess.run([train_op_d, train_op_g, loss_d, loss_g, summary_op, metrics_eval], feed_dict={keep_prob: k_prob}, options=run_options, run_metadata=run_metadata)
+            log_scheduler.done(step)
+            if perf_monitor:
+              perf_monitor.step_end(step, run_metadata)
 
-          if step % 100 == 0:
             print('OUTPUT: Step %d: loss_g = %.3f, loss_d = %.3f' % (step, loss_value_g, loss_value_d))
 
             # output some data to the log files for tensorboard
@@ -181,15 +329,28 @@ with graph.as_default():
 
             print(metrics_str)
 
-            # less frequently output checkpoint files.  Used for evaluating the model
-          if step % 1000 == 0:
-            save_path = saver.save(sess, os.path.join(outvariablesdirname, modelname), global_step=step)
+            if perf_monitor:
+              perf_monitor.report(step)
+
+          else:
+            _d, _g, loss_value_g = sess.run([train_op_d, train_op_g, loss_g], feed_dict={keep_prob: k_prob})
+            if perf_monitor:
+              perf_monitor.step_end(step)
+
+          # less frequently output checkpoint files.  Used for evaluating the model
+          checkpoint_loss.add(loss_value_g)
+          if checkpoint_scheduler.is_due(step):
+            checkpointer.save(sess, step, checkpoint_loss.mean())
+            checkpoint_loss.reset()
+            checkpoint_scheduler.done(step)
 
           step += 1
 
         except tf.errors.OutOfRangeError:
           break
 
+      checkpointer.close()
+
       outmodelname = os.path.join(outvariablesdirname, modelname)
       print('Step:', step)
       print('Saving model:', outmodelname)
@@ -208,7 +369,10 @@ with graph.as_default():
 
     summary_op = tf.summary.merge_all()
 
-    with tf.Session() as sess:
+    # The checkpoints are written in the background, the snapshot variables are created before the initialization
+    checkpointer = train_utils.AsyncCheckpointer(outvariablesdirname, modelname, max_to_keep=max_to_keep, keep_best=keep_best, iterator=iterator if save_iterator else None, run_id=resume_checkpoint.get("run") if resume_checkpoint else None)
+
+    with tf.Session(config=config) as sess:
 
       sess.run([tf.global_variables_initializer(), tf.local_variables_initializer()])
       saver = tf.train.Saver()
@@ -220,13 +384,32 @@ with graph.as_default():
 
       sess.run([iterator.initializer])
       step = 0
+      log_scheduler = train_utils.StepScheduler(steps=log_steps, secs=log_secs)
+      checkpoint_scheduler = train_utils.StepScheduler(steps=checkpoint_steps, secs=checkpoint_secs)
+      # Mean loss of the steps since the last checkpoint, the checkpoints are ranked with it for keep_best
+      checkpoint_loss = train_utils.RunningMean()
+      perf_monitor = train_utils.PerfMonitor(os.path.join(summary_path, "perf.jsonl"), summary_writer, batch_size) if perf else None
+
+      if resume_checkpoint:
+        # The global step is a variable of the checkpoint, the loop continues after the step of the checkpoint
+        checkpointer.restore(sess, resume_checkpoint)
+        step = resume_checkpoint["step"] + 1
+        checkpoint_scheduler.done(resume_checkpoint["step"])
 
       while True:
         try:
 
-          _, loss_value, summary, metrics = sess.run([train_step, loss, summary_op, metrics_eval], feed_dict={keep_prob: k_prob})
+          if perf_monitor:
+            perf_monitor.step_begin()
+
+          if log_scheduler.is_due(step):
+            # The summaries and the streaming metrics only run in the logging steps
+            run_options, run_metadata = perf_monitor.trace() if perf_monitor else (None, None)
+            _, loss_value, summary, metrics = sess.run([train_step, loss, summary_op, metrics_eval], feed_dict={keep_prob: k_prob}, options=run_options, run_metadata=run_metadata)
+            log_scheduler.done(step)
+            if perf_monitor:
+              perf_monitor.step_end(step, run_metadata)
 
-          if step % 100 == 0:
             print('OUTPUT: Step %d: loss = %.3f' % (step, loss_value))
 
             # output some data to the log files for tensorboard
@@ -240,15 +423,28 @@ with graph.as_default():
 
             print(metrics_str)
 
-            # less frequently output checkpoint files.  Used for evaluating the model
-          if step % 1000 == 0:
-            save_path = saver.save(sess, os.path.join(outvariablesdirname, modelname), global_step=step)
+            if perf_monitor:
+              perf_monitor.report(step)
+
+          else:
+            _, loss_value = sess.run([train_step, loss], feed_dict={keep_prob: k_prob})
+            if perf_monitor:
+              perf_monitor.step_end(step)
+
+          # less frequently output checkpoint files.  Used for evaluating the model
+          checkpoint_loss.add(loss_value)
+          if checkpoint_scheduler.is_due(step):
+            checkpointer.save(sess, step, checkpoint_loss.mean())
+            checkpoint_loss.reset()
+            checkpoint_scheduler.done(step)
 
           step += 1
 
         except tf.errors.OutOfRangeError:
           break
 
+      checkpointer.close()
+
       outmodelname = summary_path
       print('Step:', step)
       print('Saving model:', outmodelname + "-" + str(step))
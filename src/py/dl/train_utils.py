@@ -0,0 +1,347 @@
+from __future__ import print_function
+import numpy as np
+import tensorflow as tf
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import tempfile
+import resource
+import threading
+
+class StepScheduler:
+  # Decides if an operation runs in the current training step, i.e., summaries, metrics or checkpoints.
+  # It is due every 'steps' steps and/or every 'secs' seconds, the first step is always due
+
+  def __init__(self, steps=None, secs=None):
+    self.steps = steps
+    self.secs = secs
+    self.last_step = None
+    self.last_time = time.time()
+
+  def is_due(self, step):
+    if(self.last_step is None):
+      return True
+    if(self.steps and step - self.last_step >= self.steps):
+      return True
+    if(self.secs and time.time() - self.last_time >= self.secs):
+      return True
+    return False
+
+  def done(self, step):
+    self.last_step = step
+    self.last_time = time.time()
+
+class RunningMean:
+  # Mean of the values added since the last reset, i.e., the training loss between two checkpoints
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.total = 0.0
+    self.count = 0
+
+  def add(self, value):
+    self.total += float(value)
+    self.count += 1
+
+  def mean(self):
+    if(self.count == 0):
+      return None
+    return self.total/self.count
+
+class PerfMonitor:
+  # Throughput, step time percentiles, fraction of the step waiting for the input pipeline and memory of the process.
+  # The step time is measured in every step. The input wait is measured with a trace of the logging steps, these steps
+  # are not used for the step time. The values are written to tensorboard and as json lines to filename
+
+  def __init__(self, filename=None, summary_writer=None, batch_size=1):
+    self.filename = filename
+    self.summary_writer = summary_writer
+    self.batch_size = batch_size
+    self.step_times = []
+    self.input_wait = []
+    self.start = None
+    self.window_start = time.time()
+    self.window_steps = 0
+
+  def trace(self):
+    # Run options and metadata for a step that is traced
+    return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+  def step_begin(self):
+    self.start = time.time()
+
+  def step_end(self, step, run_metadata=None):
+    step_time = time.time() - self.start
+    self.window_steps += 1
+    if(run_metadata is not None):
+      self.input_wait.append(min(1.0, get_input_wait(run_metadata)/step_time))
+    else:
+      self.step_times.append(step_time)
+
+  def report(self, step):
+    elapsed = time.time() - self.window_start
+
+    perf = {}
+    perf["step"] = step
+    perf["time"] = time.time()
+    perf["steps_per_sec"] = self.window_steps/elapsed
+    perf["examples_per_sec"] = self.window_steps*self.batch_size/elapsed
+    if(len(self.step_times) > 0):
+      for p in [50, 90, 99]:
+        perf["step_time_p" + str(p)] = float(np.percentile(self.step_times, p))
+    if(len(self.input_wait) > 0):
+      perf["input_wait_fraction"] = float(np.mean(self.input_wait))
+    perf["rss_mb"] = get_rss()/(1024*1024)
+
+    print('PERF: Step %d: %.1f examples/sec | step time p50 = %.3f s | input wait = %.2f | rss = %.0f MB' % (step, perf["examples_per_sec"], perf.get("step_time_p50", 0), perf.get("input_wait_fraction", 0), perf["rss_mb"]))
+
+    if(self.summary_writer):
+      summary = tf.Summary(value=[tf.Summary.Value(tag="perf/" + key, simple_value=perf[key]) for key in perf if key not in ["step", "time"]])
+      self.summary_writer.add_summary(summary, step)
+
+    if(self.filename):
+      with open(self.filename, "a") as f:
+        f.write(json.dumps(perf) + "\n")
+
+    self.step_times = []
+    self.input_wait = []
+    self.window_start = time.time()
+    self.window_steps = 0
+
+def get_input_wait(run_metadata):
+  # Seconds spent in the IteratorGetNext op of a traced step
+  wait = 0
+  for dev_stats in run_metadata.step_stats.dev_stats:
+    for node_stats in dev_stats.node_stats:
+      if(node_stats.node_name.startswith("IteratorGetNext")):
+        wait = max(wait, node_stats.all_end_rel_micros/1e6)
+  return wait
+
+def get_rss():
+  # Resident memory of the process in bytes. If /proc is not available, the peak resident memory is used
+  try:
+    with open("/proc/self/statm", "r") as f:
+      return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+  except Exception:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+class AsyncCheckpointer:
+  # Writes the checkpoints from a background thread so the training loop does not wait for the storage.
+  # The variables are copied to snapshot variables in the graph (a device copy between two steps) and the thread saves the snapshot
+  # with the names of the original variables, i.e., the checkpoints are restored with a plain tf.train.Saver.
+  # A checkpoint is complete when <checkpoint>.done exists, the 'checkpoint' state file only lists complete checkpoints.
+  # The max_to_keep newest checkpoints and the keep_best checkpoints with the lowest value (loss) are kept, the others are removed.
+  # If an iterator is given, the position of the input pipeline is saved in <checkpoint>.iterator. The state can't be copied to a variable,
+  # it is serialized in the training loop to a local temporary directory and the thread moves it next to the checkpoint.
+  # The state has the records in the shuffle and prefetch buffers, its size is printed after the first save.
+  # The checkpoints are named <modelname>-<run_id>-<step>, the retention only removes the checkpoints of this run.
+  # A resumed training passes the run_id of its checkpoint and continues the same run
+
+  def __init__(self, dirname, modelname, var_list=None, max_to_keep=5, keep_best=0, iterator=None, run_id=None):
+    self.dirname = dirname
+    self.modelname = modelname
+    self.max_to_keep = max_to_keep
+    self.keep_best = keep_best
+    self.run_id = run_id if run_id else time.strftime("%Y%m%d-%H%M%S")
+    self.checkpoints = list_checkpoints(dirname, modelname, self.run_id)
+    self.thread = None
+
+    if(var_list is None):
+      var_list = tf.global_variables()
+
+    # The snapshots are local variables, they are not saved by the other savers and they are initialized with tf.local_variables_initializer
+    snapshots = {}
+    with tf.name_scope("checkpoint_snapshot"):
+      for var in var_list:
+        snapshots[var.op.name] = tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name=var.op.name)
+      self.snapshot_op = tf.group(*[snapshots[var.op.name].assign(var) for var in var_list])
+
+    self.saver = tf.train.Saver(snapshots, max_to_keep=None)
+    self.var_saver = tf.train.Saver(var_list, max_to_keep=None)
+
+    self.iterator_saver = None
+    self.iterator_dir = None
+    if(iterator is not None):
+      self.iterator_saver = tf.train.Saver([tf.contrib.data.make_saveable_from_iterator(iterator)], max_to_keep=None)
+      self.iterator_dir = tempfile.mkdtemp(prefix="iterator-")
+      self.iterator_size = None
+
+  def save(self, sess, step, value=None):
+    # Returns False if the previous checkpoint is still being written, the checkpoint is skipped
+    if(self.thread is not None and self.thread.is_alive()):
+      print("Checkpoint", step, "skipped, the previous checkpoint is still being written", file=sys.stderr)
+      return False
+
+    checkpoint_path = os.path.join(self.dirname, self.modelname + "-" + self.run_id + "-" + str(step))
+
+    # A checkpoint with the same name is overwritten, it is not complete until the new marker is written
+    if(os.path.exists(checkpoint_path + ".done")):
+      os.remove(checkpoint_path + ".done")
+    self.checkpoints = [c for c in self.checkpoints if c["path"] != checkpoint_path]
+
+    sess.run(self.snapshot_op)
+    iterator_path = self.save_iterator(sess, checkpoint_path)
+
+    self.thread = threading.Thread(target=self.write, args=(sess, checkpoint_path, step, value, iterator_path))
+    self.thread.start()
+    return True
+
+  def save_iterator(self, sess, checkpoint_path):
+    # Returns the prefix of the state in the temporary directory or None.
+    # Not every dataset can be saved, i.e., py_func. In that case only the variables are saved from now on
+    if(self.iterator_saver is None):
+      return None
+    iterator_path = os.path.join(self.iterator_dir, os.path.basename(checkpoint_path) + ".iterator")
+    try:
+      self.iterator_saver.save(sess, iterator_path, write_meta_graph=False, write_state=False)
+      if(self.iterator_size is None):
+        self.iterator_size = sum([os.path.getsize(filename) for filename in glob.glob(iterator_path + ".*")])
+        print("State of the input pipeline: %.1f MB, reduce buffer_size or shuffle_mem_mb if it is too large" % (self.iterator_size/(1024*1024)))
+      return iterator_path
+    except Exception as e:
+      print("The state of the input pipeline can't be saved, only the variables are saved", e, file=sys.stderr)
+      self.iterator_saver = None
+      for filename in glob.glob(iterator_path + ".*"):
+        os.remove(filename)
+      return None
+
+  def write(self, sess, checkpoint_path, step, value, iterator_path):
+    try:
+      self.saver.save(sess, checkpoint_path)
+
+      iterator_saved = iterator_path is not None
+      if(iterator_saved):
+        for filename in glob.glob(iterator_path + ".*"):
+          shutil.move(filename, os.path.join(self.dirname, os.path.basename(filename)))
+
+      # The marker is renamed so it never exists partially written
+      checkpoint = {"step": step, "value": value, "time": time.time(), "iterator": iterator_saved, "run": self.run_id}
+      with open(checkpoint_path + ".done.tmp", "w") as f:
+        f.write(json.dumps(checkpoint))
+      os.rename(checkpoint_path + ".done.tmp", checkpoint_path + ".done")
+
+      checkpoint["path"] = checkpoint_path
+      self.checkpoints.append(checkpoint)
+      self.remove_checkpoints()
+      tf.train.update_checkpoint_state(self.dirname, checkpoint_path, [checkpoint["path"] for checkpoint in self.checkpoints])
+    except Exception as e:
+      print("Error writing checkpoint", step, e, file=sys.stderr)
+
+  def remove_checkpoints(self):
+    keep = self.checkpoints
+    if(self.max_to_keep):
+      keep = self.checkpoints[-self.max_to_keep:]
+    if(self.keep_best):
+      best = sorted([checkpoint for checkpoint in self.checkpoints if checkpoint["value"] is not None], key=lambda checkpoint: checkpoint["value"])
+      keep = keep + [checkpoint for checkpoint in best[:self.keep_best] if checkpoint not in keep]
+
+    for checkpoint in self.checkpoints:
+      if(checkpoint not in keep):
+        # The marker goes first so the checkpoint is incomplete before its files are removed
+        if(os.path.exists(checkpoint["path"] + ".done")):
+          os.remove(checkpoint["path"] + ".done")
+        for filename in glob.glob(checkpoint["path"] + ".*"):
+          os.remove(filename)
+
+    self.checkpoints = [checkpoint for checkpoint in self.checkpoints if checkpoint in keep]
+
+  def restore(self, sess, checkpoint):
+    # Restores the variables and the position of the input pipeline if it was saved. checkpoint is an entry of list_checkpoints,
+    # the iterator must be initialized before
+    self.var_saver.restore(sess, checkpoint["path"])
+    if(checkpoint.get("iterator") and self.iterator_saver is not None):
+      self.iterator_saver.restore(sess, checkpoint["path"] + ".iterator")
+      return True
+    return False
+
+  def close(self):
+    # Waits for the checkpoint being written
+    if(self.thread is not None):
+      self.thread.join()
+    if(self.iterator_dir is not None):
+      shutil.rmtree(self.iterator_dir, ignore_errors=True)
+
+def list_checkpoints(dirname, modelname, run_id=None):
+  # Complete checkpoints written by AsyncCheckpointer, i.e., with a .done marker, sorted by step. If run_id is set, only the checkpoints of the run
+  checkpoints = []
+  for done_filename in glob.glob(os.path.join(dirname, modelname + "-*.done")):
+    with open(done_filename, "r") as f:
+      checkpoint = json.load(f)
+    checkpoint["path"] = done_filename[:-len(".done")]
+    if(run_id is None or checkpoint.get("run") == run_id):
+      checkpoints.append(checkpoint)
+  return sorted(checkpoints, key=lambda checkpoint: checkpoint["step"])
+
+def latest_checkpoint(dirname, modelname):
+  # The complete checkpoint written last, i.e., the last checkpoint of the latest run, or None.
+  # A run with more steps that was written before is not picked
+  checkpoints = list_checkpoints(dirname, modelname)
+  if(len(checkpoints) > 0):
+    return max(checkpoints, key=lambda checkpoint: checkpoint["time"])
+  return None
+
+# Arguments of the session that are set with add_session_args, the --args JSON of train.py or the file written by session_autotune.py
+SESSION_ARGS = ["intra_op_threads", "inter_op_threads", "cpu_affinity", "omp_threads", "kmp_blocktime", "kmp_affinity"]
+
+def add_session_args(parser):
+  parser.add_argument('--intra_op_threads', help='Number of threads used inside an op, i.e., a convolution. Default is the number of cpus or the number of cpus in --cpu_affinity', type=int, default=None)
+  parser.add_argument('--inter_op_threads', help='Number of ops run in parallel. Default is the number of cpus', type=int, default=None)
+  parser.add_argument('--cpu_affinity', help='Cpus used by the process, i.e., 0-15,32-47. Jobs that share a node should use different cpus', type=str, default=None)
+  parser.add_argument('--omp_threads', help='OMP_NUM_THREADS of the MKL/oneDNN builds of tensorflow', type=int, default=None)
+  parser.add_argument('--kmp_blocktime', help='KMP_BLOCKTIME in ms of the MKL/oneDNN builds, time a thread waits for work before sleeping', type=int, default=None)
+  parser.add_argument('--kmp_affinity', help='KMP_AFFINITY of the MKL/oneDNN builds, i.e., granularity=fine,compact,1,0', type=str, default=None)
+  parser.add_argument('--session_config', help='JSON file written by session_autotune.py. The configuration found for the nn and the input shape is used for the session arguments that are not set', type=str, default=None)
+
+def session_key(neural_network, data_description):
+  # The configurations of session_autotune.py are recorded for each nn and shape of the input, i.e., the first data key
+  data_key = data_description["data_keys"][0]
+  return neural_network + ":" + "x".join([str(s) for s in data_description[data_key]["shape"]])
+
+def load_session_args(filename, key, session_args):
+  # Fills the arguments that are not set with the configuration recorded for key
+  session_args = dict(session_args)
+  with open(filename, "r") as f:
+    session_configs = json.load(f)
+  if(key in session_configs):
+    for arg in SESSION_ARGS:
+      if(session_args.get(arg) is None and session_configs[key].get(arg) is not None):
+        session_args[arg] = session_configs[key][arg]
+  else:
+    print("No configuration for", key, "in", filename, file=sys.stderr)
+  return session_args
+
+def parse_cpus(cpus):
+  # "0-3,8" -> [0, 1, 2, 3, 8]
+  cpu_list = []
+  for cpu_range in cpus.split(","):
+    cpu_range = cpu_range.split("-")
+    cpu_list.extend(range(int(cpu_range[0]), int(cpu_range[-1]) + 1))
+  return cpu_list
+
+def session_config(intra_op_threads=None, inter_op_threads=None, cpu_affinity=None, omp_threads=None, kmp_blocktime=None, kmp_affinity=None):
+  # Sets the cpu affinity and the OpenMP environment of the process and returns the tf.ConfigProto of the session.
+  # OpenMP reads the environment when the first op runs and tensorflow creates its thread pools with the first session,
+  # call it before the first session is created
+  if(cpu_affinity):
+    cpus = parse_cpus(cpu_affinity)
+    os.sched_setaffinity(0, cpus)
+    if(intra_op_threads is None):
+      intra_op_threads = len(cpus)
+  if(omp_threads is not None):
+    os.environ["OMP_NUM_THREADS"] = str(omp_threads)
+  if(kmp_blocktime is not None):
+    os.environ["KMP_BLOCKTIME"] = str(kmp_blocktime)
+  if(kmp_affinity):
+    os.environ["KMP_AFFINITY"] = kmp_affinity
+
+  config = tf.ConfigProto()
+  if(intra_op_threads is not None):
+    config.intra_op_parallelism_threads = intra_op_threads
+  if(inter_op_threads is not None):
+    config.inter_op_parallelism_threads = inter_op_threads
+  return config